@@ -20,31 +20,435 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import copy
 import sys
 import traceback
 import time
 import argparse
-import urllib3
-from abiquo.client import Abiquo, check_response
-from requests_oauthlib import OAuth1
+import copy
+import fcntl
+import hashlib
+import itertools
+import marshal
+import queue
+import random
+import socket
+import sqlite3
+import string
+import subprocess
+import threading
+import tempfile
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+
+try:
+    from contextlib import nullcontext # py3.7
+except ImportError:
+    @contextmanager
+    def nullcontext():
+        yield
 
 try:
     import ConfigParser # py2
 except ModuleNotFoundError:
     import configparser # py3
 
-try:
-    from http.client import HTTPConnection # py3
-except ImportError:
-    from httplib import HTTPConnection # py2
-
 try:
     import json
 except ImportError:
     import simplejson as json
 
+# The Abiquo client, requests and friends are only imported when the API is
+# actually queried, so answering from the cache stays cheap.
+
+def check_response(expected_code, code, errors):
+    from abiquo.client import check_response as abiquo_check_response
+    abiquo_check_response(expected_code, code, errors)
+
+# Layout of the cache database, bump it whenever the tables change
+CACHE_SCHEMA = '3'
+
+CacheFormat = namedtuple('CacheFormat', ['version', 'dumps', 'loads'])
+
+def cache_formats():
+    ''' Serializations available for the cache rows, by name '''
+    formats = {
+        'json': CacheFormat('1', json.dumps, json.loads),
+        'json.zlib': CacheFormat('1', lambda o: zlib.compress(json.dumps(o).encode('utf-8')),
+                                 lambda b: json.loads(zlib.decompress(b).decode('utf-8'))),
+        # marshal data can only be read back by the same Python version
+        'marshal': CacheFormat('%d.%d-%d' % (sys.version_info[0], sys.version_info[1], marshal.version),
+                               marshal.dumps, marshal.loads),
+    }
+    try:
+        import msgpack
+        formats['msgpack'] = CacheFormat('1', msgpack.packb, lambda b: msgpack.unpackb(b, raw=False))
+    except ImportError:
+        pass
+    return formats
+
+def replace_file_atomically(path, build):
+    ''' Lets build() create a temporary file and renames it over path '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.%s' % os.path.basename(path))
+    os.close(fd)
+    try:
+        build(tmp)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+def write_file_atomically(path, content):
+    def build(tmp):
+        with open(tmp, 'w') as f:
+            f.write(content)
+    replace_file_atomically(path, build)
+
+def iter_compact_json(obj, encode, depth=3, batch=1000):
+    ''' Encodes obj as compact JSON in chunks
+
+    Dicts in the first depth levels of obj are written a batch of items at
+    a time, each batch encoded by encode() in one go. The output is never
+    held in memory as a whole, while the encoder still does most of the work.
+    '''
+    if depth == 0 or not isinstance(obj, dict):
+        yield encode(obj)
+        return
+
+    separator = '{'
+    items = {}
+    for key, value in obj.items():
+        if depth > 1 and isinstance(value, dict):
+            yield separator + encode(key) + ':'
+            for chunk in iter_compact_json(value, encode, depth - 1, batch):
+                yield chunk
+            separator = ','
+        else:
+            items[key] = value
+            if len(items) >= batch:
+                yield separator + encode(items)[1:-1]
+                separator, items = ',', {}
+    if items:
+        yield separator + encode(items)[1:-1]
+        separator = ','
+    yield '{}' if separator == '{' else '}'
+
+def join_chunks(chunks, size=65536):
+    ''' Joins small chunks so they are written in fewer, larger writes '''
+    buffered, length = [], 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffered)
+            buffered, length = [], 0
+    if buffered:
+        yield ''.join(buffered)
+
+# Groups hosts are added to, by family. Each rule is a group name pattern
+# whose fields are facts of the host (see AbiquoInventory.host_facts). Facts
+# with several values, like networks or variables, give one group per value,
+# and rules using a fact the host does not have are skipped.
+GROUP_RULES = (
+    ('name', '{name}'),
+    ('template', 'template_{template}'),
+    ('vapp', 'vapp_{vapp}'),
+    ('vdc', 'vdc_{vdc}'),
+    ('vdc_vapp', 'vdc_{vdc}_vapp_{vapp}'),
+    ('hwprofile', 'hwprof_{hwprofile}'),
+    ('variable', 'var_{variable}'),
+    ('network', 'network_{network}'),
+    ('dstier', 'dstier_{dstier}'),
+    ('firewall', 'firewall_{firewall}'),
+    ('loadbalancer', 'loadbalancer_{loadbalancer}'),
+)
+
+# Data fetched for each VM on top of the VM listing, one request or more
+# per VM each. The IP address is read from the VM links when NICs are not
+# fetched, and network names need the NICs.
+ENRICHMENT_DATA = ('nics', 'networks', 'disks', 'volumes', 'template', 'metadata')
+
+# Credentials of the [auth] section, a [source NAME] section setting any of
+# them does not inherit the others
+AUTH_OPTIONS = ('apiuser', 'apipass', 'api_key', 'api_secret', 'token', 'token_secret')
+
+# Actions of the VIRTUAL_MACHINE events of the event stream that change the
+# host entry of a VM, other events are ignored
+VM_EVENT_ACTIONS = frozenset(['CREATE', 'DEPLOY_FINISH', 'UNDEPLOY_FINISH', 'RECONFIGURE', 'DELETE'])
+
+# VMs refreshed by --refresh-scope: those of a virtual datacenter and/or
+# virtual appliance, by id, of the given source if there are several
+RefreshScope = namedtuple('RefreshScope', ['source', 'vdc', 'vapp'])
+
+def parse_refresh_scope(value):
+    ''' Parses vdc_ID, vapp_ID or vdc_ID_vapp_ID, optionally prefixed with the source name and a colon '''
+    source, _, scope = value.rpartition(':')
+    vdc = vapp = None
+    if scope.startswith('vdc_'):
+        vdc, found, vapp = scope[len('vdc_'):].partition('_vapp_')
+        vapp = vapp if found else None
+    elif scope.startswith('vapp_'):
+        vapp = scope[len('vapp_'):]
+    ids = [id for id in (vdc, vapp) if id is not None]
+    if not ids or not all(id.isdigit() for id in ids):
+        raise argparse.ArgumentTypeError("invalid scope '%s', expected vdc_ID, vapp_ID or vdc_ID_vapp_ID" % value)
+    return RefreshScope(source or None, vdc, vapp)
+
+@lru_cache(maxsize=4096)
+def sanitize_name(name):
+    return name.replace('[','').replace(']','').replace(' ','_').replace('/','_')
+
+@lru_cache(maxsize=4096)
+def sanitize_title(title):
+    ''' Template, vApp, VDC and hardware profile names keep their slashes '''
+    return title.replace('[','').replace(']','').replace(' ','_')
+
+def index_links(links):
+    ''' Groups links by rel in a single pass '''
+    index = {}
+    for link in links:
+        index.setdefault(link['rel'], []).append(link)
+    return index
+
+class GroupRules(object):
+    ''' Group name patterns, compiled once and applied to the facts of each host '''
+    def __init__(self, patterns):
+        self.rules = []
+        for pattern in patterns:
+            # Fields become positional, so a group name is a single format()
+            # call on the values of the facts, whatever their names are
+            template, fields = '', []
+            try:
+                parsed = list(string.Formatter().parse(pattern))
+            except ValueError as e:
+                raise ValueError("Invalid group pattern '%s': %s\n" % (pattern, e))
+            for literal, field, spec, conversion in parsed:
+                template += literal.replace('{', '{{').replace('}', '}}')
+                if field is not None:
+                    template += '{%d%s%s}' % (len(fields), '!' + conversion if conversion else '',
+                                              ':' + spec if spec else '')
+                    fields.append(field)
+            self.rules.append((template, tuple(fields)))
+
+    def groups(self, facts):
+        ''' Names of the groups of a host with the given facts, without duplicates '''
+        groups = {}
+        for template, fields in self.rules:
+            if len(fields) == 1:
+                for value in facts.get(fields[0], ()):
+                    groups[template.format(value)] = None
+            else:
+                for values in itertools.product(*[facts.get(field, ()) for field in fields]):
+                    groups[template.format(*values)] = None
+        return list(groups)
+
+# Volumes by the href of the VM they are attached to, and private IPs by
+# their own href with the link to their network, of a virtual datacenter
+VDCIndex = namedtuple('VDCIndex', ['volumes', 'ips'])
+
+class VMRecord(object):
+    ''' What the host entry of a VM is built from
+
+    API payloads are reduced to these fields as soon as they are fetched,
+    instead of being added to the VM JSON, so they are not kept in memory
+    while the VM is enriched.
+    '''
+    __slots__ = ('dto', 'links', 'ip', 'networks', 'login_user', 'vars')
+
+    def __init__(self, dto):
+        # The VM from the listing, to follow its links and read its attributes
+        self.dto = dto
+        self.links = index_links(dto.links)
+        self.ip = None
+        self.networks = ()
+        self.login_user = ''
+        self.vars = {}
+
+    def add_vars(self, items):
+        ''' Keeps the attributes that become host vars, those starting with abq '''
+        for key, value in items:
+            if key.startswith('abq'):
+                self.vars['abq_%s' % key] = value
+
+class TemplateCache(object):
+    ''' Stores VM templates by template link href, persisted between runs '''
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.fetching = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            cache = open(self.path, 'r')
+            data = json.loads(cache.read())
+            cache.close()
+        except (IOError, ValueError):
+            return
+
+        now = time.time()
+        # Entries are stored from least to most recently used
+        for href, fetched, template in data.get('templates', []):
+            if now - fetched <= self.ttl:
+                self.entries[href] = (fetched, template)
+        self.evict()
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        with self.lock:
+            data = {'templates': [[href, fetched, template] for href, (fetched, template) in self.entries.items()]}
+        try:
+            write_file_atomically(self.path, json.dumps(data))
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+    def lookup(self, href):
+        entry = self.entries.get(href)
+        if entry is None or time.time() - entry[0] > self.ttl:
+            return None
+        self.entries.move_to_end(href)
+        return entry[1]
+
+    def get(self, href, fetch):
+        ''' Returns the template for href, calling fetch() only on a miss '''
+        with self.lock:
+            template = self.lookup(href)
+            if template is not None:
+                return template
+            href_lock = self.fetching.setdefault(href, threading.Lock())
+
+        # Only one worker fetches a given template, the rest wait for it
+        with href_lock:
+            with self.lock:
+                template = self.lookup(href)
+            if template is not None:
+                return template
+
+            template = fetch()
+            with self.lock:
+                self.entries[href] = (time.time(), template)
+                self.entries.move_to_end(href)
+                self.evict()
+                self.fetching.pop(href, None)
+                self.dirty = True
+            return template
+
+class ResponseMemo(object):
+    ''' Remembers the latest API responses by href and accept header during a single run '''
+    def __init__(self, max_entries=256):
+        # None keeps every response
+        self.max_entries = max_entries
+        self.responses = OrderedDict()
+        self.fetching = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, href, accept, fetch):
+        ''' Returns the response for href, calling fetch() only the first time '''
+        key = (href, accept)
+        with self.lock:
+            if key in self.responses:
+                self.hits += 1
+                return self.responses[key]
+            key_lock = self.fetching.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                if key in self.responses:
+                    self.hits += 1
+                    return self.responses[key]
+                self.misses += 1
+
+            response = fetch()
+            with self.lock:
+                # Most responses belong to a single VM, keeping all of them
+                # would hold the whole fleet's payloads until the end
+                self.responses[key] = response
+                if self.max_entries is not None and len(self.responses) > self.max_entries:
+                    self.responses.popitem(last=False)
+                self.fetching.pop(key, None)
+            return response
+
+class Profiler(object):
+    ''' Collects API request statistics and phase timings for --profile '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.phases = OrderedDict()
+        self.vms = OrderedDict()
+
+    def record_request(self, endpoint, seconds, size):
+        with self.lock:
+            self.requests.setdefault(endpoint, []).append((seconds, size))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                calls, total = self.phases.get(name, (0, 0.0))
+                self.phases[name] = (calls + 1, total + elapsed)
+
+    def count_vms(self, counts):
+        with self.lock:
+            for status, count in counts.items():
+                self.vms[status] = self.vms.get(status, 0) + count
+
+    def percentile(self, values, percent):
+        index = int(round(percent / 100.0 * (len(values) - 1)))
+        return values[index]
+
+    def report(self):
+        requests = {}
+        for endpoint, samples in self.requests.items():
+            latencies = sorted(seconds * 1000 for seconds, size in samples)
+            requests[endpoint] = {
+                'count': len(samples),
+                'bytes': sum(size for seconds, size in samples),
+                'latency_ms': {
+                    'p50': round(self.percentile(latencies, 50), 2),
+                    'p90': round(self.percentile(latencies, 90), 2),
+                    'p99': round(self.percentile(latencies, 99), 2),
+                    'max': round(latencies[-1], 2),
+                },
+            }
+        # Phases that run in the worker pool add up the time of all workers
+        phases = dict((name, {'calls': calls, 'total_ms': round(total * 1000, 2)})
+                      for name, (calls, total) in self.phases.items())
+        return {'requests': requests, 'phases': phases, 'vms': dict(self.vms)}
+
+    def write(self, destination):
+        report = json.dumps(self.report(), sort_keys=True, indent=2) + '\n'
+        if destination == '-':
+            sys.stderr.write(report)
+        else:
+            with open(destination, 'w') as f:
+                f.write(report)
+
 class AbiquoInventory(object):
+    # Name of the [source NAME] section queried, None for [api] and [auth]
+    source = None
+    # Hosts of the inventory by VM URL, known after it is refreshed
+    vm_hosts = None
+
     def _empty_inventory(self):
         return {"_meta": {"hostvars": {}}}
 
@@ -55,22 +459,84 @@ class AbiquoInventory(object):
         '''Initialise'''
         self.parse_cli_args()
         self.get_config()
-        self.init_client()
 
-        if self.args.refresh_cache:
-            inv = self.generate_inv_from_api()
-        elif not self.cache_available():
-            inv = self.generate_inv_from_api()
-        else:
-            inv = self.get_cache()
+        self.profiler = Profiler() if self.args.profile else None
+        self.request_sizes = threading.local()
+        if self.args.daemon:
+            self.serve()
+            return
 
-        if self.cache_enabled():
-            self.save_cache(inv)
-
-        if self.args.host:
-            sys.stdout.write(json.dumps(inv['_meta']['hostvars'][self.args.host], sort_keys=True, indent=2))
+        try:
+            self.run()
+        finally:
+            if self.profiler is not None:
+                self.profiler.write(self.args.profile)
+
+    def run(self):
+        refresh = self.args.refresh_cache or self.args.refresh_scope is not None
+        if not refresh and not self.args.profile and self.args.revalidate_lock_fd is None \
+                and self.query_daemon():
+            return
+
+        sources = self.sources() or [self]
+        if self.args.host and not refresh and all(source.cache_available() for source in sources):
+            # Only this host's vars are read from the cache index
+            self.write_output(self.find_cached_host(self.args.host, sources))
+            return
+
+        if self.args.revalidate_lock_fd is not None:
+            # Background refresh started by a process that served a stale cache
+            source = self.source_inventory(self.args.revalidate_source) if self.args.revalidate_source else self
+            source.revalidate(os.fdopen(self.args.revalidate_lock_fd))
+            return
+
+        if self.args.refresh_scope is not None:
+            inv = self.load_scoped_inventory(self.args.refresh_scope)
+        else:
+            inv = self.load_inventory()
+        with self.timed('output'):
+            self.write_output(inv['_meta']['hostvars'].get(self.args.host, {}) if self.args.host else inv)
+
+    def timed(self, phase):
+        ''' Context manager timing a phase when profiling '''
+        if self.profiler is None:
+            return nullcontext()
+        return self.profiler.phase(phase)
+
+    def render(self, inv, host=None):
+        ''' Output for --list, or for --host when host is given '''
+        if host:
+            return ''.join(self.iter_output(inv['_meta']['hostvars'].get(host, {})))
         else:
-            sys.stdout.write(json.dumps(inv, sort_keys=True, indent=2))
+            return ''.join(self.iter_output(inv))
+
+    def write_output(self, obj):
+        ''' Writes obj to stdout as JSON while it is encoded '''
+        write = sys.stdout.write
+        for chunk in self.iter_output(obj):
+            write(chunk)
+
+    def iter_output(self, obj):
+        ''' Encodes obj as JSON in chunks, indented and sorted unless the output style is compact '''
+        if self.output_style() == 'compact':
+            return join_chunks(iter_compact_json(obj, self.compact_encoder()))
+        return join_chunks(json.JSONEncoder(sort_keys=True, indent=2).iterencode(obj))
+
+    def output_style(self):
+        style = os.getenv("ABIQUO_INV_OUTPUT_STYLE")
+        if style:
+            return style
+        if self.config.has_option('output', 'style'):
+            return self.config.get('output', 'style')
+        return 'pretty'
+
+    def compact_encoder(self):
+        ''' orjson if it is installed, the standard library otherwise '''
+        try:
+            import orjson
+            return lambda obj: orjson.dumps(obj).decode('utf-8')
+        except ImportError:
+            return json.JSONEncoder(separators=(',', ':')).encode
     
     def fail_with_error(self, e):
         sys.stderr.write(str(e))
@@ -86,6 +552,17 @@ class AbiquoInventory(object):
                             help='Get all the variables about a specific VM')
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                             help='Force refresh of cache by making API requests (default: False - use cache files)')
+        parser.add_argument('--refresh-scope', action='store', type=parse_refresh_scope, metavar='SCOPE',
+                            help='Refresh only the VMs of a virtual datacenter or appliance, vdc_ID, vapp_ID or '
+                                 'vdc_ID_vapp_ID, merging them into the cache')
+        parser.add_argument('--profile', action='store', nargs='?', const='-', metavar='FILE',
+                            help='Write API request and timing statistics as JSON to FILE (default: stderr)')
+        parser.add_argument('--daemon', action='store_true', default=False,
+                            help='Keep the inventory in memory and serve it over a Unix socket (default: False)')
+        parser.add_argument('--revalidate-lock-fd', action='store', type=int,
+                            help=argparse.SUPPRESS)
+        parser.add_argument('--revalidate-source', action='store',
+                            help=argparse.SUPPRESS)
         self.args = parser.parse_args()
 
     def get_config(self):
@@ -102,8 +579,17 @@ class AbiquoInventory(object):
             self.config = configparser.ConfigParser()
 
     def init_client(self):
+        import urllib3
+        from abiquo.client import Abiquo
+        from requests_oauthlib import OAuth1
+        try:
+            from http.client import HTTPConnection # py3
+        except ImportError:
+            from httplib import HTTPConnection # py2
+
         api_url = self.config_get('api', 'uri')
-        verify = self.config.getboolean('api', 'ssl_verify') if self.config.has_option('api', 'ssl_verify') else None
+        api_section = self.config_section('api', 'ssl_verify')
+        verify = self.config.getboolean(api_section, 'ssl_verify') if self.config.has_option(api_section, 'ssl_verify') else None
         api_user = self.config_get('auth', 'apiuser')
         api_pass = self.config_get('auth', 'apipass')
         app_key = self.config_get('auth', 'api_key')
@@ -153,16 +639,188 @@ class AbiquoInventory(object):
         else:
             raise ValueError('Either basic auth or OAuth creds are required.')
 
+        self.session = self.http_session()
         self.api = Abiquo(api_url, auth=creds, verify=verify)
+        self.api.session = self.session
         if not verify:
             urllib3.disable_warnings()
 
         if os.environ.get('ABQ_DEBUG'):
             HTTPConnection.debuglevel = 1
 
+    def http_session(self):
+        ''' HTTP session shared by all API requests, with keep-alive and retries '''
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        class JitteredRetry(Retry):
+            # Full jitter, so workers retrying at once do not hit the API in lockstep
+            def get_backoff_time(self):
+                return random.uniform(0, super(JitteredRetry, self).get_backoff_time())
+
+        retries = JitteredRetry(
+            total=self.retries(),
+            backoff_factor=self.retry_backoff(),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            # Once retries are exhausted, return the last response so
+            # check_response reports the error
+            raise_on_status=False,
+        )
+        # One connection per worker, plus the one listing VMs
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers() + 1, max_retries=retries)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.profiler is not None:
+            session.hooks['response'].append(self.record_response_size)
+        return session
+
     def config_get(self, section, option):
+        section = self.config_section(section, option)
         return self.config.get(section, option) if self.config.has_option(section, option) else None
 
+    def config_section(self, section, option):
+        ''' Section an [api] or [auth] option is read from, the source's own one if it sets it '''
+        if self.source is None:
+            return section
+        source_section = 'source ' + self.source
+        if self.config.has_option(source_section, option):
+            return source_section
+        if section == 'auth' and any(self.config.has_option(source_section, name) for name in AUTH_OPTIONS):
+            return source_section
+        return section
+
+    def sources(self):
+        ''' Inventories of the [source NAME] sections, by name, or none if there is a single API '''
+        if self.source is not None:
+            return []
+        names = sorted(section[len('source '):].strip() for section in self.config.sections()
+                       if section.startswith('source '))
+        return [self.source_inventory(name) for name in names]
+
+    def source_inventory(self, name):
+        ''' Copy of this inventory querying the API of the [source NAME] section '''
+        source = copy.copy(self)
+        source.source = name
+        return source
+
+    def map_sources(self, func, sources):
+        ''' Applies func to every source concurrently, returns the results in source order '''
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            return list(executor.map(func, sources))
+
+    def merge_inventories(self, inventories):
+        ''' Merges the inventories of several sources
+
+        Groups list the hosts of every source, in source order. A host found
+        in several sources gets the vars of the first one.
+        '''
+        merged = self._empty_inventory()
+        hostvars = merged['_meta']['hostvars']
+        for inv in inventories:
+            for host, host_vars in inv.get('_meta', {}).get('hostvars', {}).items():
+                hostvars.setdefault(host, host_vars)
+            for group, hosts in inv.items():
+                if group != '_meta':
+                    merged.setdefault(group, {}).update(dict.fromkeys(hosts))
+        self.finish_groups(merged)
+        return merged
+
+    def vdc_ids(self):
+        ''' Virtual datacenters whose VMs are listed, all of them if there are none '''
+        if self.source is None:
+            value = self.find_config_value("ABIQUO_INV_VDC", "vdc")
+        else:
+            value = self.config.get('source ' + self.source, 'vdc', fallback=None)
+        ids = [vdc.strip() for vdc in (value or '').split(',') if vdc.strip()]
+        return list(OrderedDict.fromkeys(ids))
+
+    def workers(self):
+        env_workers = os.getenv("ABIQUO_INV_WORKERS")
+        if env_workers is not None:
+            return int(env_workers)
+        elif self.config.has_option('api', 'workers'):
+            return self.config.getint('api', 'workers')
+        else:
+            return 4
+
+    def retries(self):
+        env_retries = os.getenv("ABIQUO_INV_RETRIES")
+        if env_retries is not None:
+            return int(env_retries)
+        elif self.config.has_option('api', 'retries'):
+            return self.config.getint('api', 'retries')
+        else:
+            return 3
+
+    def retry_backoff(self):
+        env_backoff = os.getenv("ABIQUO_INV_RETRY_BACKOFF")
+        if env_backoff is not None:
+            return float(env_backoff)
+        elif self.config.has_option('api', 'retry_backoff'):
+            return self.config.getfloat('api', 'retry_backoff')
+        else:
+            return 0.5
+
+    def max_failure_ratio(self):
+        env_ratio = os.getenv("ABIQUO_INV_MAX_FAILURE_RATIO")
+        if env_ratio is not None:
+            return float(env_ratio)
+        elif self.config.has_option('api', 'max_failure_ratio'):
+            return self.config.getfloat('api', 'max_failure_ratio')
+        else:
+            return 0.1
+
+    def page_size(self):
+        env_page_size = os.getenv("ABIQUO_INV_PAGE_SIZE")
+        if env_page_size is not None:
+            return int(env_page_size)
+        elif self.config.has_option('api', 'page_size'):
+            return self.config.getint('api', 'page_size')
+        else:
+            return 100
+
+    def daemon_socket(self):
+        env_socket = os.getenv("ABIQUO_INV_DAEMON_SOCKET")
+        if env_socket is not None:
+            return os.path.expanduser(env_socket)
+        elif self.config.has_option('daemon', 'socket'):
+            return os.path.expanduser(self.config.get('daemon', 'socket'))
+        else:
+            return self.cache_path('abiquo-inventory%s.sock' % self.cache_key())
+
+    def events_enabled(self):
+        events = False
+        if self.config.has_option('events', 'enabled'):
+            events = self.config.getboolean('events', 'enabled')
+
+        if os.environ.get("ABIQUO_INV_EVENTS"):
+            events = True
+
+        return events
+
+    def events_url(self):
+        ''' Event stream of the API, by default /m/stream on the same server '''
+        stream_url = self.config_get('events', 'stream_url')
+        if stream_url:
+            return stream_url
+        api_url = self.api.url.rstrip('/')
+        if api_url.endswith('/api'):
+            api_url = api_url[:-len('/api')]
+        return api_url + '/m/stream'
+
+    def reconcile_interval(self):
+        env_interval = os.getenv("ABIQUO_INV_RECONCILE_INTERVAL")
+        if env_interval is not None:
+            return int(env_interval)
+        elif self.config.has_option('events', 'reconcile_interval'):
+            return self.config.getint('events', 'reconcile_interval')
+        else:
+            return 3600
+
     def cache_enabled(self):
         use_cache = True
         if self.config.has_option('cache', 'use_cache'):
@@ -173,15 +831,150 @@ class AbiquoInventory(object):
 
         return use_cache
 
-    def cache_file(self):
+    def cache_path(self, name):
         env_cache_dir = os.getenv("ABIQUO_INV_CACHE_DIR")
         if env_cache_dir is not None:
-            return os.path.expanduser(os.path.join(env_cache_dir, 'abiquo-inventory'))
+            return os.path.expanduser(os.path.join(env_cache_dir, name))
         elif self.config.has_option('cache', 'cache_dir'):
-            return os.path.expanduser(os.path.join(self.config.get('cache', 'cache_dir'), 'abiquo-inventory'))
+            return os.path.expanduser(os.path.join(self.config.get('cache', 'cache_dir'), name))
         else:
-            return os.path.expanduser(os.path.join('~', '.ansible', 'tmp', 'abiquo-inventory'))
-            
+            return os.path.expanduser(os.path.join('~', '.ansible', 'tmp', name))
+
+    def cache_file(self):
+        return self.cache_path('abiquo-inventory%s.db' % self.cache_key())
+
+    def cache_key(self):
+        ''' Keeps the cache of each source and enrichment profile apart, the default ones have no key '''
+        profile = self.enrichment_profile()
+        if profile == self.enrichment_profile(default=True):
+            return self.source_key()
+        return self.source_key() + '-' + hashlib.sha1(json.dumps(profile, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+    def source_key(self):
+        return '' if self.source is None else '-' + sanitize_name(self.source)
+
+    def incremental_refresh(self):
+        incremental = False
+        if self.config.has_option('cache', 'incremental'):
+            incremental = self.config.getboolean('cache', 'incremental')
+
+        if os.environ.get("ABIQUO_INV_INCREMENTAL"):
+            incremental = True
+
+        return incremental and self.cache_enabled()
+
+    def prefetch_enabled(self):
+        prefetch = False
+        if self.config.has_option('api', 'prefetch'):
+            prefetch = self.config.getboolean('api', 'prefetch')
+
+        if os.environ.get("ABIQUO_INV_PREFETCH"):
+            prefetch = True
+
+        return prefetch
+
+    def enrichment_settings(self):
+        ''' Settings that change how a VM becomes a host entry '''
+        return {
+            'deployed_only': bool(self.find_boolean_config_value("ABIQUO_INV_DEPLOYED_ONLY", "deployed_only")),
+            'public_ip_only': bool(self.find_boolean_config_value("ABIQUO_INV_PUBLIC_IP_ONLY", "public_ip_only")),
+            'default_net_interface': self.find_config_value("ABIQUO_INV_DEFAULT_IFACE", "default_net_interface"),
+            'profile': self.enrichment_profile(),
+            'groups': self.group_patterns(),
+        }
+
+    def enrichment_profile(self, default=False):
+        ''' Data fetched for each VM and families of groups built, from the [profile] section '''
+        get_md = self.find_boolean_config_value("ABIQUO_INV_GET_METADATA", "get_metadata")
+        families = [family for family, _ in GROUP_RULES]
+        try:
+            return {
+                # Metadata is only fetched by default if get_metadata is set
+                'data': self.profile_option("ABIQUO_INV_PROFILE_DATA", 'data', ENRICHMENT_DATA,
+                                            [data for data in ENRICHMENT_DATA if data != 'metadata' or get_md],
+                                            default),
+                'groups': self.profile_option("ABIQUO_INV_PROFILE_GROUPS", 'groups', families, families, default),
+            }
+        except ValueError as e:
+            self.fail_with_error(e)
+
+    def profile_option(self, env_variable_name, option, choices, default_choices, default=False):
+        value = None if default else os.getenv(env_variable_name)
+        if not value and not default and self.config.has_option('profile', option):
+            value = self.config.get('profile', option)
+
+        if not value:
+            return list(default_choices)
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        if names == ['all']:
+            return list(choices)
+        if names == ['none']:
+            return []
+        unknown = [name for name in names if name not in choices]
+        if unknown:
+            raise ValueError("Unknown %s in the enrichment profile: %s\n" % (option, ', '.join(unknown)))
+        return [name for name in choices if name in names]
+
+    def group_patterns(self):
+        ''' Patterns of the user defined groups, on top of GROUP_RULES '''
+        env = os.getenv("ABIQUO_INV_GROUPS")
+        if env:
+            return [pattern.strip() for pattern in env.split(',') if pattern.strip()]
+        if self.config.has_section('groups'):
+            return [pattern for _, pattern in sorted(self.config.items('groups'))]
+        return []
+
+    def group_rules(self):
+        try:
+            families = self.settings['profile']['groups']
+            return GroupRules([pattern for family, pattern in GROUP_RULES if family in families] +
+                              self.settings['groups'])
+        except ValueError as e:
+            self.fail_with_error(e)
+
+    def get_snapshot(self):
+        ''' Returns the VMs seen in the previous refresh, if they were built with the same settings '''
+        try:
+            snapshot_file = open(self.cache_path('abiquo-vms%s' % self.cache_key()), 'r')
+            snapshot = json.loads(snapshot_file.read())
+            snapshot_file.close()
+        except (IOError, ValueError):
+            return {}
+
+        if snapshot.get('settings') != self.settings:
+            return {}
+        return snapshot.get('vms', {})
+
+    def save_snapshot(self, vms):
+        snapshot = {'settings': self.settings, 'vms': vms}
+        try:
+            write_file_atomically(self.cache_path('abiquo-vms%s' % self.cache_key()), json.dumps(snapshot))
+        except (IOError, OSError):
+            pass
+
+    def template_cache_ttl(self):
+        env_cache_ttl = os.getenv("ABIQUO_INV_TEMPLATE_CACHE_TTL")
+        if env_cache_ttl is not None:
+            return int(env_cache_ttl)
+        elif self.config.has_option('cache', 'template_max_age'):
+            return self.config.getint('cache', 'template_max_age')
+        else:
+            return 86400
+
+    def template_cache_size(self):
+        env_cache_size = os.getenv("ABIQUO_INV_TEMPLATE_CACHE_SIZE")
+        if env_cache_size is not None:
+            return int(env_cache_size)
+        elif self.config.has_option('cache', 'template_cache_size'):
+            return self.config.getint('cache', 'template_cache_size')
+        else:
+            return 1000
+
+    def template_cache(self):
+        # Templates are shared by all profiles, but not across sources
+        path = self.cache_path('abiquo-templates%s' % self.source_key()) if self.cache_enabled() else None
+        return TemplateCache(path, self.template_cache_ttl(), self.template_cache_size())
+
     def cache_ttl(self):
         env_cache_ttl = os.getenv("ABIQUO_INV_CACHE_TTL")
         if env_cache_ttl is not None:
@@ -191,248 +984,638 @@ class AbiquoInventory(object):
         else:
             return 600
 
+    def cache_stale_ttl(self):
+        env_stale_ttl = os.getenv("ABIQUO_INV_CACHE_STALE_TTL")
+        if env_stale_ttl is not None:
+            return int(env_stale_ttl)
+        elif self.config.has_option('cache', 'stale_max_age'):
+            return self.config.getint('cache', 'stale_max_age')
+        else:
+            return 0
+
+    def cache_lock_timeout(self):
+        if self.config.has_option('cache', 'lock_timeout'):
+            return self.config.getint('cache', 'lock_timeout')
+        else:
+            return 300
+
+    def cache_format(self):
+        ''' Name of the serialization used to write the cache '''
+        name = os.getenv("ABIQUO_INV_CACHE_FORMAT")
+        if name is None and self.config.has_option('cache', 'format'):
+            name = self.config.get('cache', 'format')
+        # Fall back to JSON if the format is unknown or not installed
+        if name not in cache_formats():
+            name = 'json'
+        return name
+
+    def cache_mtime(self):
+        try:
+            mtime = os.stat(self.cache_file()).st_mtime
+        except:
+            return None
+
+        # A cache written by another version, or in a format this Python
+        # cannot read, is as good as no cache at all
+        try:
+            cache, cache_format = self.open_cache()
+            cache.close()
+        except sqlite3.Error:
+            return None
+
+        return mtime
+
+    def cache_age(self):
+        mtime = self.cache_mtime()
+        if mtime is None:
+            return None
+
+        return int(time.time()) - int(mtime)
+
+    def loaded_cache_age(self):
+        ''' Age of the cache load_inventory() returned, 0 if it was generated from the API '''
+        if not self.cache_enabled() and not self.cache_available():
+            return 0
+        return self.cache_age() or 0
+
     def cache_available(self):
         ''' checks if we have a 'fresh' cache available for item requested '''
+        age = self.cache_age()
+        return age is not None and age <= self.cache_ttl()
+
+    def cache_stale_available(self):
+        ''' checks if an expired cache can still be served while it is refreshed '''
+        age = self.cache_age()
+        return age is not None and age <= self.cache_ttl() + self.cache_stale_ttl()
+
+    def lock_cache(self, blocking):
+        ''' Takes the cache refresh lock, returns the locked file or None '''
         try:
-            existing = os.stat(self.cache_file())
-        except:
-            return False
+            lock = open(self.cache_path('abiquo-inventory%s.lock' % self.cache_key()), 'a')
+        except IOError:
+            return None
+
+        deadline = time.time() + self.cache_lock_timeout()
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except (IOError, OSError):
+                if not blocking or time.time() > deadline:
+                    lock.close()
+                    return None
+            time.sleep(0.1)
+
+    def refresh_cache(self, lock):
+        ''' Generates the inventory and saves it, releasing the lock afterwards '''
+        try:
+            inv = self.generate_inv_from_api()
+            self.save_cache(inv)
+            return inv
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def revalidate(self, lock):
+        ''' Refreshes the cache with a lock inherited from the parent process '''
+        if self.cache_available():
+            lock.close()
+        else:
+            self.refresh_cache(lock)
+
+    def revalidate_in_background(self, lock):
+        ''' Hands the lock over to a detached process that refreshes the cache '''
+        devnull = open(os.devnull, 'r+')
+        source_args = ['--revalidate-source', self.source] if self.source is not None else []
+        subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0]),
+                          '--revalidate-lock-fd', str(lock.fileno())] + source_args,
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         pass_fds=(lock.fileno(),), start_new_session=True)
+        devnull.close()
+        lock.close()
+
+    def load_inventory(self):
+        ''' Returns the inventory from the cache, refreshing it if needed
+
+        Only one process refreshes the cache at a time. The others wait for
+        it to finish, or serve the expired cache straight away if it is
+        still within the stale_max_age window. With several sources, each one
+        is loaded in parallel from its own cache and they are merged.
+        '''
+        sources = self.sources()
+        if sources:
+            return self.merge_inventories(self.map_sources(lambda source: source.load_inventory(), sources))
+
+        if not self.args.refresh_cache and self.cache_available():
+            with self.timed('load_cache'):
+                return self.get_cache()
+
+        if not self.cache_enabled():
+            return self.generate_inv_from_api()
+
+        lock = self.lock_cache(blocking=False)
+        if lock is None:
+            # Someone else is refreshing the cache
+            if not self.args.refresh_cache and self.cache_stale_available():
+                return self.get_cache()
+
+            started = time.time()
+            lock = self.lock_cache(blocking=True)
+            if lock is not None and (self.cache_mtime() or 0) >= started:
+                # The cache was just refreshed by the process we waited for
+                lock.close()
+                return self.get_cache()
+        elif not self.args.refresh_cache:
+            if self.cache_available():
+                lock.close()
+                return self.get_cache()
+            elif self.cache_stale_available():
+                self.revalidate_in_background(lock)
+                return self.get_cache()
+
+        return self.refresh_cache(lock)
+
+    def load_scoped_inventory(self, scope):
+        ''' Returns the inventory with the VMs in scope refreshed, the other sources are loaded as usual '''
+        sources = self.sources()
+        if not sources:
+            if scope.source is not None:
+                raise SystemExit("There is no [source %s] section" % scope.source)
+            return self.refresh_scope(scope)
+
+        names = [source.source for source in sources]
+        if scope.source not in names:
+            raise SystemExit("The scope must start with the source it refreshes, one of %s, as in %s:vdc_1"
+                             % (', '.join(names), names[0]))
+        return self.merge_inventories(self.map_sources(
+            lambda source: source.refresh_scope(scope) if source.source == scope.source else source.load_inventory(),
+            sources))
+
+    def refresh_scope(self, scope):
+        ''' Enriches the VMs of a virtual datacenter or appliance again and merges them into the cache
+
+        Hosts of other VMs, and the age of the cache, are left as they are.
+        Without a cache to merge into, the whole inventory is refreshed.
+        '''
+        if not self.cache_enabled():
+            raise SystemExit("--refresh-scope merges into the cache, which is disabled")
+        lock = self.lock_cache(blocking=True)
+        try:
+            mtime = self.cache_mtime()
+            if mtime is None:
+                return self.refresh_cache(lock)
+
+            inventory = self.get_cache()
+            vm_hosts = self.vm_hosts = self.get_cached_vm_hosts()
+            last_known = self.last_known_hosts(inventory, vm_hosts)
+            self.prepare_refresh()
+            try:
+                vdc = scope.vdc or self.find_vapp_vdc(scope.vapp, vm_hosts)
+                vdc_ids = self.vdc_ids()
+                if vdc_ids and vdc not in vdc_ids:
+                    raise ValueError("Virtual datacenter %s is not one of the listed ones, %s" % (vdc, ', '.join(vdc_ids)))
+                if scope.vapp is not None:
+                    vms = self.get_vms_by_vapp(vdc, scope.vapp)
+                    path = '/virtualdatacenters/%s/virtualappliances/%s/' % (vdc, scope.vapp)
+                else:
+                    vms = self.get_vms_by_vdc(vdc)
+                    path = '/virtualdatacenters/%s/' % vdc
+
+                counts = OrderedDict([('fresh', 0), ('stale', 0), ('dropped', 0)])
+                refreshed = []
+                for key, entry, status in self.map_vms(lambda vm: self.refresh_vm(vm, {}, last_known.get), vms):
+                    refreshed.append((key, entry))
+                    if status is not None:
+                        counts[status] += 1
+                self.check_failures(counts)
+            except Exception as e:
+                self.fail_with_error(e)
+            finally:
+                self.templates.save()
+
+            # VMs in scope that are gone, or filtered out now, lose their
+            # hosts, and the refreshed hosts leave the groups they were in
+            dests = set(vm_hosts.pop(href) for href in [href for href in vm_hosts if path in href])
+            dests.update(entry['host']['dest'] for key, entry in refreshed if entry['host'] is not None)
+            self.remove_hosts_from_inventory(inventory, dests)
+            for key, entry in refreshed:
+                if entry['host'] is not None:
+                    self.append_host_to_inventory(inventory, entry['host'])
+                    vm_hosts[key] = entry['host']['dest']
+
+            self.save_cache(inventory)
+            try:
+                os.utime(self.cache_file(), (mtime, mtime))
+            except OSError:
+                pass
+            if self.incremental_refresh():
+                snapshot = self.get_snapshot()
+                snapshot.update(refreshed)
+                self.save_snapshot(snapshot)
+            return inventory
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def load_revalidated_inventory(self):
+        ''' Waits for the background refresh of the cache to finish, then loads the inventory '''
+        lock = self.lock_cache(blocking=True)
+        if lock is not None:
+            lock.close()
+        return self.load_inventory()
+
+    def reload_inventory(self):
+        ''' Generates the inventory of every source, saving it if the cache is enabled '''
+        sources = self.sources()
+        if sources:
+            return self.merge_inventories(self.map_sources(lambda source: source.reload_inventory(), sources))
 
-        if ((int(time.time()) - int(existing.st_mtime)) <= self.cache_ttl()):
-            return True
+        if self.cache_enabled():
+            return self.refresh_cache(self.lock_cache(blocking=True))
+        return self.generate_inv_from_api()
 
-        return False
+    def open_cache(self):
+        ''' Opens the cache database read-only, returns it with the format of its rows '''
+        cache = sqlite3.connect('file:%s?mode=ro' % self.cache_file(), uri=True)
+        try:
+            header = dict(cache.execute('SELECT key, value FROM header'))
+            cache_format = cache_formats().get(header.get('format'))
+            if header.get('schema') != CACHE_SCHEMA or cache_format is None \
+                    or header.get('format_version') != cache_format.version:
+                raise sqlite3.DatabaseError('unsupported cache %s' % header)
+        except:
+            cache.close()
+            raise
+        return cache, cache_format
 
     def get_cache(self):
         ''' returns cached item  '''
         inv = {}
         try:
-            cache = open(self.cache_file(), 'r')
-            inv = json.loads(cache.read())
+            cache, cache_format = self.open_cache()
+            loads = cache_format.loads
+            hostvars = dict((name, loads(host_vars)) for name, host_vars in
+                            cache.execute('SELECT name, vars FROM hosts ORDER BY rowid'))
+            inv = dict((name, loads(hosts)) for name, hosts in
+                       cache.execute('SELECT name, hosts FROM groups ORDER BY rowid'))
+            inv['_meta'] = {'hostvars': hostvars}
             cache.close()
-        except IOError:
+        except sqlite3.Error:
             pass # not really sure what to do here
 
         return inv
 
-    def save_cache(self, data):
-        ''' saves item to cache '''
+    def get_cached_host(self, host):
+        ''' returns the cached vars of a single host '''
+        host_vars = {}
         try:
-            cache = open(self.cache_file(), 'w+')
-            cache.write(json.dumps(data))
+            cache, cache_format = self.open_cache()
+            row = cache.execute('SELECT vars FROM hosts WHERE name = ?', (host,)).fetchone()
+            if row is not None:
+                host_vars = cache_format.loads(row[0])
             cache.close()
-        except IOError:
-            pass # not really sure what to do here
+        except sqlite3.Error:
+            pass
 
-    def get_vms(self):
-        code, vms = self.api.cloud.virtualmachines.get(
-            headers={'accept': 'application/vnd.abiquo.virtualmachines+json'}
-        )
-        try:
-            check_response(200, code, vms)
-        except Exception as e:
-            self.fail_with_error(e)
-        return vms
-
-    def get_vms_by_vdc(self, vdc:str):
-        code, vms = self.api.cloud.virtualdatacenters(vdc).action.virtualmachines.get(
-            headers={'accept': 'application/vnd.abiquo.virtualmachines+json'}
-        )
-        try:
-            check_response(200, code, vms)
-        except Exception as e:
-            self.fail_with_error(e)
-        return vms
+        return host_vars
 
-    def update_vm_metadata(self, vm):
-        code, metadata = vm.follow('metadata').get()
+    def get_cached_vm_hosts(self):
+        ''' returns the cached hosts by VM URL '''
+        vm_hosts = {}
         try:
-            check_response(200, code, metadata)
-        except Exception as e:
-            self.fail_with_error(e)
-        vm.json['metadata'] = metadata.json
+            cache, cache_format = self.open_cache()
+            vm_hosts = dict(cache.execute('SELECT href, host FROM vms'))
+            cache.close()
+        except sqlite3.Error:
+            pass
+
+        return vm_hosts
+
+    def get_last_known_hosts(self):
+        ''' returns the cached host entries by VM URL, with their vars and groups '''
+        if not self.cache_enabled():
+            return {}
+        inv = self.get_cache()
+        if not inv:
+            return {}
+        return self.last_known_hosts(inv, self.get_cached_vm_hosts())
+
+    def last_known_hosts(self, inv, vm_hosts):
+        ''' Host entries of the VMs of an inventory by VM URL, with their vars and groups '''
+        groups = {}
+        for group, hosts in inv.items():
+            if group != '_meta':
+                for dest in hosts:
+                    groups.setdefault(dest, []).append(group)
+        hostvars = inv['_meta']['hostvars']
+        return dict((href, {'dest': dest, 'vars': hostvars[dest], 'groups': groups.get(dest, [])})
+                    for href, dest in vm_hosts.items() if dest in hostvars)
+
+    def find_cached_host(self, host, sources):
+        ''' returns the cached vars of a host from the first source that has it '''
+        for source in sources:
+            host_vars = source.get_cached_host(host)
+            if host_vars:
+                return host_vars
+        return {}
 
-    def update_vm_template(self, vm):
-        template = self.get_vm_template(vm)
-        json = template.json
-        del json['links']
-        vm.json['template'] = json
+    def save_cache(self, data):
+        ''' saves item to cache '''
+        # Host vars are stored one row per host, indexed by name, so --host
+        # does not need to load the whole inventory.
+        name = self.cache_format()
+        cache_format = cache_formats()[name]
+
+        def build(tmp):
+            cache = sqlite3.connect(tmp)
+            cache.execute('PRAGMA journal_mode = OFF')
+            cache.execute('CREATE TABLE header (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            cache.execute('CREATE TABLE hosts (name TEXT PRIMARY KEY, vars BLOB NOT NULL)')
+            cache.execute('CREATE TABLE groups (name TEXT PRIMARY KEY, hosts BLOB NOT NULL)')
+            cache.execute('CREATE TABLE vms (href TEXT PRIMARY KEY, host TEXT NOT NULL)')
+            cache.executemany('INSERT INTO header VALUES (?, ?)',
+                              [('schema', CACHE_SCHEMA), ('format', name), ('format_version', cache_format.version)])
+            cache.executemany('INSERT INTO hosts VALUES (?, ?)',
+                              ((name, cache_format.dumps(host_vars)) for name, host_vars in data['_meta']['hostvars'].items()))
+            cache.executemany('INSERT INTO groups VALUES (?, ?)',
+                              ((name, cache_format.dumps(hosts)) for name, hosts in data.items() if name != '_meta'))
+            cache.executemany('INSERT INTO vms VALUES (?, ?)', (self.vm_hosts or {}).items())
+            cache.commit()
+            cache.close()
 
-    def update_vm_disks_and_nics(self, vm):
-        vm_nics = []
-        vm_disks = []
-        nics = self.get_vm_nics(vm)
-        disks = self.get_vm_disks(vm)
-        vols = self.get_vm_volumes(vm)
+        try:
+            replace_file_atomically(self.cache_file(), build)
+        except (IOError, OSError, sqlite3.Error):
+            pass # not really sure what to do here
 
-        for nic in nics:
-            vm_nics.append(nic.json)
+    def iter_collection(self, client, media_type, endpoint, required=True):
+        ''' Yields the items of a paginated collection, requesting one page at a time
+
+        Errors are fatal for required collections, and raised otherwise.
+        '''
+        from abiquo.client import ObjectDto
+        page_size = self.page_size()
+        startwith = 0
+        while True:
+            code, page = self.api_get(
+                client, endpoint,
+                params={'limit': page_size, 'startwith': startwith},
+                headers={'accept': media_type}
+            )
+            try:
+                check_response(200, code, page)
+            except Exception as e:
+                if not required:
+                    raise
+                self.fail_with_error(e)
+
+            items = page.json.get('collection', [])
+            for item in items:
+                yield ObjectDto(item, auth=client.auth, verify=client.verify)
+
+            startwith += len(items)
+            if len(items) == 0 or not page._has_link('next'):
+                break
 
-        for disk in disks:
-            vm_disks.append(disk.json)
+    def get_vms(self):
+        return self.iter_collection(self.api.cloud.virtualmachines,
+                                    'application/vnd.abiquo.virtualmachines+json', 'virtualmachines')
 
-        for vol in vols:
-            vm_disks.append(vol.json)
+    def get_vms_by_vdc(self, vdc:str):
+        return self.iter_collection(self.api.cloud.virtualdatacenters(vdc).action.virtualmachines,
+                                    'application/vnd.abiquo.virtualmachines+json', 'virtualmachines')
+
+    def get_vms_by_vapp(self, vdc, vapp):
+        return self.iter_collection(self.api.cloud.virtualdatacenters(vdc).virtualappliances(vapp).virtualmachines,
+                                    'application/vnd.abiquo.virtualmachines+json', 'virtualmachines')
+
+    def find_vapp_vdc(self, vapp, vm_hosts):
+        ''' Id of the virtual datacenter of a virtual appliance, from the URLs of its cached VMs if it has any '''
+        marker = '/virtualappliances/%s/' % vapp
+        for href in vm_hosts:
+            head, found, _ = href.partition(marker)
+            if found and '/virtualdatacenters/' in head:
+                return head.rsplit('/', 1)[1]
+
+        vdc_ids = self.vdc_ids() or [str(vdc.id) for vdc in self.iter_collection(
+            self.api.cloud.virtualdatacenters, 'application/vnd.abiquo.virtualdatacenters+json', 'virtualdatacenters')]
+        for vdc_id in vdc_ids:
+            code, _ = self.api_get(self.api.cloud.virtualdatacenters(vdc_id).virtualappliances(vapp), 'virtualappliances',
+                                   headers={'accept': 'application/vnd.abiquo.virtualappliance+json'})
+            if code == 200:
+                return vdc_id
+        raise ValueError("Virtual appliance %s not found" % vapp)
+
+    def update_vm_metadata(self, record):
+        code, metadata = self.follow(record.dto, 'metadata')
+        check_response(200, code, metadata)
+        record.add_vars([('metadata', metadata.json)])
+
+    def update_vm_template(self, record):
+        def fetch():
+            json = dict(self.get_vm_template(record.dto).json)
+            del json['links']
+            return json
+
+        href = record.links['virtualmachinetemplate'][0]['href']
+        template = self.templates.get(href, fetch)
+        record.login_user = template['loginUser'] if 'loginUser' in template else ''
+        record.add_vars([('template', template)])
+
+    def update_vm_nics(self, record):
+        ''' Reads the IP address, networks and NIC vars of a VM '''
+        data = self.settings['profile']['data']
+        if 'nics' not in data and 'networks' not in data:
+            record.ip = self.get_vm_link_ip(record)
+            return
+
+        index = self.get_vdc_index(record)
+        nics = self.join_vm_nics(record, index) if index is not None else None
+        if nics is None:
+            nics = [nic.json for nic in self.get_vm_nics(record.dto)]
+        record.ip = self.get_vm_ip(nics)
+        if record.ip is not None:
+            if 'networks' in data:
+                record.networks = self.get_vm_network_names(nics)
+            if 'nics' in data:
+                record.add_vars(self.nic_json_to_dict(nics).items())
+
+    def update_vm_disks(self, record):
+        data = self.settings['profile']['data']
+        disks = []
+        if 'disks' in data:
+            disks.extend(disk.json for disk in self.get_vm_disks(record.dto))
+        if 'volumes' in data:
+            index = self.get_vdc_index(record)
+            if index is not None and 'edit' in record.links:
+                # Every volume of the VDC is in the index, so a VM that is not
+                # there has no volumes
+                disks.extend(index.volumes.get(record.links['edit'][0]['href'], []))
+            else:
+                disks.extend(vol.json for vol in self.get_vm_volumes(record.dto))
+        if disks:
+            record.add_vars(self.disk_json_to_dict(disks).items())
+
+    def get_vdc_index(self, record):
+        ''' Prefetched volumes and private IPs of the VDC of a VM, None if they are not available '''
+        link = record.links.get('virtualdatacenter')
+        if self.vdc_indexes is None or not link:
+            return None
+        return self.vdc_indexes.get(link[0]['href'], None, lambda: self.prefetch_vdc(record.dto))
+
+    def prefetch_vdc(self, vm):
+        ''' Fetches the volumes and private IPs of the VDC of a VM, once for all its VMs '''
+        index = VDCIndex({}, {})
+        vdc = vm.follow('virtualdatacenter')
+        try:
+            for volume in self.iter_collection(vdc.volumes, 'application/vnd.abiquo.volumes+json', 'volumes',
+                                               required=False):
+                vm_link = volume._extract_link('virtualmachine')
+                if vm_link:
+                    index.volumes.setdefault(vm_link['href'], []).append(volume.json)
+
+            for network in self.iter_collection(vdc.privatenetworks, 'application/vnd.abiquo.vlans+json',
+                                                'privatenetworks', required=False):
+                network_link = dict(network._extract_link('edit'), rel='privatenetwork', title=network.name)
+                for ip in self.iter_collection(network.follow('ips'), 'application/vnd.abiquo.privateips+json',
+                                               'ips', required=False):
+                    ip_link = ip._extract_link('edit') or ip._extract_link('self')
+                    if ip_link:
+                        index.ips[ip_link['href']] = (network_link, ip.json)
+        except Exception:
+            # The VMs of this VDC are enriched with per-VM requests
+            if os.environ.get('ABQ_DEBUG'):
+                sys.stderr.write(traceback.format_exc())
+            return None
+        return index
+
+    def join_vm_nics(self, record, index):
+        ''' NICs of a VM built from the prefetched IPs, None unless all of them were prefetched
+
+        The nicN links of a VM point to the IP of its Nth NIC, public IPs
+        and IPs of external networks are not prefetched.
+        '''
+        nics = []
+        for rel, links in record.links.items():
+            if not (rel.startswith('nic') and rel[3:].isdigit()):
+                continue
+            nic_link = links[0]
+            if nic_link['href'] not in index.ips:
+                return None
+            network_link, ip = index.ips[nic_link['href']]
+            nics.append({
+                'sequence': int(rel[3:]), 'ip': ip.get('ip'), 'mac': ip.get('mac'),
+                'links': [network_link, nic_link, dict(nic_link, rel='ip')],
+            })
+        if not nics:
+            return None
+        return sorted(nics, key=lambda nic: nic['sequence'])
+
+    def follow(self, dto, rel):
+        ''' GETs the link with the given rel, at most once per href and accept header '''
+        link = dto._extract_link(rel)
+        if not link:
+            raise KeyError("link with rel %s not found" % rel)
+        return self.responses.get(link['href'], link.get('type'),
+                                  lambda: self.api_get(dto.follow(rel), rel))
+
+    def api_get(self, client, endpoint, **kwargs):
+        ''' GETs with the given client, recording it under endpoint when profiling '''
+        # Clients built from links come with their own session, use the
+        # shared one so connections are reused
+        client.session = self.session
+        if self.profiler is None:
+            return client.get(**kwargs)
+
+        self.request_sizes.sizes = []
+        start = time.time()
+        try:
+            return client.get(**kwargs)
+        finally:
+            self.profiler.record_request(endpoint, time.time() - start, sum(self.request_sizes.sizes))
 
-        vm.json['nics'] = vm_nics
-        vm.json['disks'] = vm_disks
+    def record_response_size(self, response, *args, **kwargs):
+        sizes = getattr(self.request_sizes, 'sizes', None)
+        if sizes is not None:
+            sizes.append(len(response.content))
 
     def get_vm_template(self, vm):
-        code, template = vm.follow('virtualmachinetemplate').get()
-        try:
-            check_response(200, code, template)
-        except Exception as e:
-            self.fail_with_error(e)
+        code, template = self.follow(vm, 'virtualmachinetemplate')
+        check_response(200, code, template)
         return template
 
     def get_vm_nics(self, vm):
-        code, nics = vm.follow('nics').get()
-        try:
-            check_response(200, code, nics)
-        except Exception as e:
-            self.fail_with_error(e)
+        code, nics = self.follow(vm, 'nics')
+        check_response(200, code, nics)
         return nics
 
     def get_vm_disks(self, vm):
-        code, disks = vm.follow('harddisks').get()
-        try:
-            check_response(200, code, disks)
-        except Exception as e:
-            self.fail_with_error(e)
+        code, disks = self.follow(vm, 'harddisks')
+        check_response(200, code, disks)
 
         return disks
 
     def get_vm_volumes(self, vm):
-        code, vols = vm.follow('volumes').get()
-        try:
-            check_response(200, code, vols)
-        except Exception as e:
-            self.fail_with_error(e)
+        code, vols = self.follow(vm, 'volumes')
+        check_response(200, code, vols)
 
         return vols
     
-    def get_vm_network_names(self, vm):
+    def get_vm_network_names(self, nics_json):
         net_names = []
-        code, nics = vm.follow('nics').get()
-        try:
-            check_response(200, code, nics)
-            for nic in nics:
-                private_nic_link = nic._extract_link('privatenetwork')
-                ext_nic_link = nic._extract_link('externalnetwork')
-                pub_nic_link = nic._extract_link('publicnetwork')
-
-                if private_nic_link is not None:
-                    net_names.append(private_nic_link['title'])
-                elif ext_nic_link is not None:
-                    net_names.append(ext_nic_link['title'])
-                elif pub_nic_link is not None:
-                    net_names.append(pub_nic_link['title'])
-                else:
-                    continue
-            return net_names
-        except Exception as e:
-            self.fail_with_error(e)
-    
-    def get_vm_ds_tiers_names(self, vm):
-        tier_names = []
-        ds_tier_links = filter(lambda x: x['rel'].startswith('datastoretier'), vm.links)
-
-        for tier_link in ds_tier_links:
-            if tier_link['title'] not in tier_names:
-                tier_names.append(tier_link['title'])
-
-        return tier_names
-    
-    def get_vm_firewall_names(self, vm):
-        fw_names = []
-        fw_links = filter(lambda x: x['rel'] == 'firewall', vm.links)
-
-        for fw_link in fw_links:
-            if fw_link['title'] not in fw_names:
-                fw_names.append(fw_link['title'])
-
-        return fw_names
-
-    def get_vm_loadbalancer_names(self, vm):
-        lb_names = []
-        lb_links = filter(lambda x: x['rel'] == 'loadbalancer', vm.links)
-
-        for lb_link in lb_links:
-            if lb_link['title'] not in lb_names:
-                lb_names.append(lb_link['title'])
-
-        return lb_names
+        for nic in nics_json:
+            nic_links = index_links(nic['links'])
+            for rel in ('privatenetwork', 'externalnetwork', 'publicnetwork'):
+                if rel in nic_links:
+                    net_names.append(nic_links[rel][0]['title'])
+                    break
+        return net_names
 
     def nic_json_to_dict(self, nics_json):
-        nics = copy.copy(nics_json)
         nic_dict = {}
 
-        for nic in nics:
+        for nic in nics_json:
             nic_rel = "nic%d" % nic['sequence']
-            for key in nic:
+            for key, value in nic.items():
                 if key != 'links':
-                    nic_dict["%s_%s" % (nic_rel, key)] = nic[key]
+                    nic_dict["%s_%s" % (nic_rel, key)] = value
 
-            netlink = list(filter(lambda x: "network" in x['rel'], nic['links']))
-            if len(netlink) > 0:
-                netlink = netlink[0]
-                nic_dict["%s_net_type" % nic_rel] = netlink['rel']
+            for link in nic['links']:
+                if "network" in link['rel']:
+                    nic_dict["%s_net_type" % nic_rel] = link['rel']
+                    break
 
         return nic_dict
 
     def disk_json_to_dict(self, disks_json):
-        disks = copy.copy(disks_json)
         disk_dict = {}
 
-        for disk in disks:
+        for disk in disks_json:
             disk_rel = "disk%d" % disk['sequence']
-            for key in disk:
+            for key, value in disk.items():
                 if key != 'links':
-                    disk_dict["%s_%s" % (disk_rel, key)] = disk[key]
+                    disk_dict["%s_%s" % (disk_rel, key)] = value
 
-            tierlink = list(filter(lambda x: "tier" in x['rel'], disk['links']))
-            if len(tierlink) > 0:
-                tierlink = tierlink[0]
-                disk_dict["%s_tier" % disk_rel] = tierlink['title']
+            for link in disk['links']:
+                if "tier" in link['rel']:
+                    disk_dict["%s_tier" % disk_rel] = link['title']
+                    break
 
         return disk_dict
-    
-    def sanitize_name(self, name):
-        return name.replace('[','').replace(']','').replace(' ','_').replace('/','_')
-
-    def vars_from_json(self, vm_json):
-        vm = copy.copy(vm_json)
-        nics_dict = self.nic_json_to_dict(vm['nics'])
-        disks_dict = self.disk_json_to_dict(vm['disks'])
 
-        host_vars = dict(list(nics_dict.items()) + list(disks_dict.items()))
+    def vars_from_json(self, record):
+        ''' Adds the links and attributes of the VM to the host vars of the record and returns them
 
+        Vars are added in order of precedence, NICs and disks first, so
+        later ones with the same name win.
+        '''
         link_rels = [
             "category", "virtualmachinetemplate", "hypervisortype", "ip", "location", "hardwareprofile",
             "state", "network_configuration", "virtualappliance", "virtualdatacenter", "user", "enterprise"
         ]
-        vm_links = copy.copy(vm['links'])
-        link_dict = {}
-        for rel in link_rels:
-            links = list(filter(lambda y: y['rel'] == rel, vm_links))
-            if len(links) > 0:
-                link = links[0]
-                k = link['rel']
-                v = link['title']
-                link_dict[k] = v
-
-        attrs_dict = copy.copy(vm)
-        del attrs_dict['links']
-        del attrs_dict['nics']
-        del attrs_dict['disks']
-
-        d = dict(list(host_vars.items()) + list(link_dict.items()) + list(attrs_dict.items()))
-        vars = {}
-        for i, v in d.items():
-            if i.startswith('abq'):
-                vars['abq_%s' % i] = v
-
-        return vars
+        record.add_vars((rel, record.links[rel][0]['title']) for rel in link_rels if rel in record.links)
+        record.add_vars((key, value) for key, value in record.dto.json.items() if key != 'links')
+        return record.vars
 
     def find_config_value(self, env_variable_name: str, config_variable_name: str):
         config_value = os.environ.get(env_variable_name)
@@ -448,173 +1631,553 @@ class AbiquoInventory(object):
 
         return config_value
 
+    def process_vm(self, vm):
+        ''' Enriches a single VM and returns its host entry, or None if it is filtered out
+
+        Enrichment is staged so VMs are filtered as early and as cheaply as
+        possible: first on the VM listing itself, then on its NICs, and only
+        the VMs that will be part of the inventory get their disks, volumes,
+        template and metadata fetched.
+        '''
+        # From abiquo.ini: Only adding to inventory VMs deployed
+        if self.settings['deployed_only'] and vm.state == 'NOT_ALLOCATED':
+            return None
+
+        record = VMRecord(vm)
+        self.update_vm_nics(record)
+        if record.ip is None:
+            return None
+
+        data = self.settings['profile']['data']
+        self.update_vm_disks(record)
+        if 'template' in data:
+            self.update_vm_template(record)
+        if 'metadata' in data:
+            self.update_vm_metadata(record)
+
+        with self.timed('vars_from_json'):
+            host_vars = self.vars_from_json(record)
+
+        ## Set host vars
+        if 'fqdn' in vm.json:
+            dest = vm.fqdn
+        elif 'label' in vm.json:
+            dest = sanitize_title(vm.label)
+        else:
+            dest = sanitize_title(vm.name)
+
+        host_vars['ansible_host'] = record.ip
+        # Without the template, Ansible falls back to its own remote user
+        if 'template' in data:
+            host_vars['ansible_user'] = record.login_user
+
+        with self.timed('grouping'):
+            groups = self.grouping.groups(self.host_facts(record))
+
+        return {'dest': dest, 'vars': host_vars, 'groups': groups}
+
+    def host_facts(self, record):
+        ''' Values group rules are built from, already sanitized for group names
+
+        Every fact is a tuple of values. Besides the facts below, each VM
+        variable is also available on its own as var[<name>].
+        '''
+        links = record.links
+
+        def title(rel):
+            return tuple(sanitize_title(link['title']) for link in links.get(rel, ())[:1] if link['title'])
+
+        variables = record.dto.json.get('variables', {})
+        facts = {
+            'name': (record.dto.name,),
+            'template': title('virtualmachinetemplate'),
+            'vapp': title('virtualappliance'),
+            'vdc': title('virtualdatacenter'),
+            'hwprofile': title('hardwareprofile'),
+            'variable': tuple('%s_%s' % (sanitize_name(var), sanitize_name(val)) for var, val in variables.items()),
+            # Names of the networks the VM is connected to
+            'network': tuple(sanitize_name(name) for name in record.networks),
+            # DS tiers the VM is using, firewalls and load balancers
+            'dstier': (),
+            'firewall': (),
+            'loadbalancer': (),
+        }
+        for rel, rel_links in links.items():
+            fact = 'dstier' if rel.startswith('datastoretier') else rel
+            if fact in ('dstier', 'firewall', 'loadbalancer'):
+                facts[fact] += tuple(sanitize_name(link['title']) for link in rel_links)
+        for var, val in variables.items():
+            facts['var[%s]' % var] = (sanitize_name(val),)
+        return facts
+
+    def get_vm_ip(self, nics_json):
+        ''' Returns the IP address Ansible will use to reach the VM, if any '''
+        # From abiquo.ini: Only adding to inventory VMs with public IP
+        public_ip_only = self.settings['public_ip_only']
+        default_net_iface = self.settings['default_net_interface']
+
+        # The last matching NIC wins
+        vm_ip = None
+        for nic in nics_json:
+            for link in nic['links']:
+                if public_ip_only:
+                    if link['type'] == 'application/vnd.abiquo.publicip+json' and link['rel']== 'ip':
+                        vm_ip = link['title']
+                        break
+                # Otherwise, assigning defined network interface IP address
+                else:
+                    if link['rel'] == default_net_iface:
+                        vm_ip = link['title']
+                        break
+
+        return vm_ip
+
+    def get_vm_link_ip(self, record):
+        ''' Same as get_vm_ip, from the nicN links of the VM instead of its NICs '''
+        vm_ip = None
+        if self.settings['public_ip_only']:
+            nic_links = sorted((int(rel[3:]), links[0]) for rel, links in record.links.items()
+                               if rel.startswith('nic') and rel[3:].isdigit())
+            for _, link in nic_links:
+                if link.get('type') == 'application/vnd.abiquo.publicip+json':
+                    vm_ip = link['title']
+        elif self.settings['default_net_interface'] in record.links:
+            vm_ip = record.links[self.settings['default_net_interface']][-1]['title']
+
+        return vm_ip
+
+    def remove_host_from_inventory(self, inventory, dest):
+        ''' Removes a host from a finished inventory, dropping the groups left empty '''
+        inventory['_meta']['hostvars'].pop(dest, None)
+        for group in [group for group, hosts in inventory.items() if group != '_meta' and dest in hosts]:
+            inventory[group].remove(dest)
+            if not inventory[group]:
+                del inventory[group]
+
+    def remove_hosts_from_inventory(self, inventory, dests):
+        ''' Removes a set of hosts from a finished inventory in a single pass over its groups '''
+        hostvars = inventory['_meta']['hostvars']
+        for dest in dests:
+            hostvars.pop(dest, None)
+        for group in [group for group in inventory if group != '_meta']:
+            hosts = [host for host in inventory[group] if host not in dests]
+            if not hosts:
+                del inventory[group]
+            elif len(hosts) != len(inventory[group]):
+                inventory[group] = hosts
+
+    def append_host_to_inventory(self, inventory, host):
+        ''' Adds a host to the end of the groups of a finished inventory '''
+        inventory['_meta']['hostvars'][host['dest']] = host['vars']
+        for group in host['groups']:
+            inventory.setdefault(group, []).append(host['dest'])
+
+    def add_host_to_inventory(self, inventory, host):
+        dest = host['dest']
+        inventory['_meta']['hostvars'][dest] = host['vars']
+
+        # Groups are ordered sets of hosts while the inventory is built, so a
+        # host is listed once per group, in listing order
+        for group in host['groups']:
+            members = inventory.get(group)
+            if members is None:
+                members = inventory[group] = {}
+            members[dest] = None
+
+    def finish_groups(self, inventory):
+        ''' Turns the group sets into the host lists of the output '''
+        for group in inventory:
+            if group != '_meta':
+                inventory[group] = list(inventory[group])
+
+    def map_vms(self, func, vms):
+        ''' Lazily applies func to every VM using the worker pool, keeping the VM order '''
+        workers = self.workers()
+        if workers <= 1:
+            for vm in vms:
+                yield func(vm)
+            return
+
+        # Only a few VMs per worker are in flight at any time, so the next
+        # listing page is downloaded while the workers enrich the current
+        # one and memory is bounded by the page size, not the fleet size.
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+        try:
+            for vm in vms:
+                pending.append(executor.submit(func, vm))
+                if len(pending) >= workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Do not keep fetching if a VM failed
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def vm_fingerprint(self, vm):
+        ''' Identity and change marker of a VM, taken from the listing payload '''
+        link = vm._extract_link('edit') or vm._extract_link('self')
+        key = link['href'] if link else vm.name
+        # State, links (NICs, tiers, firewalls...) and variables are all
+        # part of the listing, so any change to them changes the digest.
+        digest = hashlib.sha1(json.dumps(vm.json, sort_keys=True).encode('utf-8')).hexdigest()
+        return key, digest
+
+    def refresh_vm(self, vm, previous, last_known):
+        ''' Returns the host entry of a VM, reusing the previous one if the VM did not change
+
+        A VM that cannot be enriched keeps its last known host, from
+        last_known(key), with the time it went stale in abq_stale_since.
+        Also returns whether the host is fresh, stale or dropped, or None
+        if the VM is filtered out.
+        '''
+        key, digest = self.vm_fingerprint(vm)
+        known = previous.get(key)
+        if known is not None and known['digest'] == digest:
+            host = known['host']
+        else:
+            try:
+                host = self.process_vm(vm)
+            except Exception as e:
+                sys.stderr.write("Could not enrich VM %s: %s\n" % (key, e))
+                if os.environ.get('ABQ_DEBUG'):
+                    sys.stderr.write(traceback.format_exc())
+                host = last_known(key)
+                if host is None:
+                    return key, {'digest': None, 'host': None}, 'dropped'
+                host_vars = dict(host['vars'])
+                host_vars.setdefault('abq_stale_since', int(time.time()))
+                # Without a digest, the VM is enriched again by the next
+                # incremental refresh
+                return key, {'digest': None, 'host': dict(host, vars=host_vars)}, 'stale'
+        return key, {'digest': digest, 'host': host}, 'fresh' if host is not None else None
+
+    def check_failures(self, counts):
+        ''' Reports the VMs that could not be enriched, failing if they are more than max_failure_ratio '''
+        if self.profiler is not None:
+            self.profiler.count_vms(counts)
+        failed = counts['stale'] + counts['dropped']
+        if not failed:
+            return
+        total = failed + counts['fresh']
+        source = '%s: ' % self.source if self.source is not None else ''
+        sys.stderr.write("%s%d VMs fresh, %d stale, %d dropped\n"
+                         % (source, counts['fresh'], counts['stale'], counts['dropped']))
+        if failed > total * self.max_failure_ratio():
+            raise ValueError("%s%d of %d VMs could not be enriched, more than max_failure_ratio"
+                             % (source, failed, total))
+
     def generate_inv_from_api(self):
-        inventory = self.inventory
+        with self.timed('refresh'):
+            return self.refresh_inventory()
+
+    def prepare_refresh(self):
+        ''' Sets up the API client, caches, settings and group rules used to enrich VMs '''
+        self.init_client()
+        self.templates = self.template_cache()
+        self.responses = ResponseMemo()
+        self.vdc_indexes = ResponseMemo(max_entries=None) if self.prefetch_enabled() else None
+        # Settings and group rules are read and compiled once per refresh
+        self.settings = self.enrichment_settings()
+        self.grouping = self.group_rules()
+
+    def refresh_inventory(self):
+        self.prepare_refresh()
+        inventory = self.inventory = self._empty_inventory()
+        vm_hosts = self.vm_hosts = {}
+        incremental = self.incremental_refresh()
+        counts = OrderedDict([('fresh', 0), ('stale', 0), ('dropped', 0)])
+
+        # The previous cache is only read once a VM fails
+        last_known = []
+        last_known_lock = threading.Lock()
+        def last_known_host(key):
+            with last_known_lock:
+                if not last_known:
+                    last_known.append(self.get_last_known_hosts())
+            return last_known[0].get(key)
+
         try:
-            vdc_id = self.find_config_value("ABIQUO_INV_VDC", "vdc")
-            if vdc_id:
-                vms = self.get_vms_by_vdc(vdc_id)
+            vdc_ids = self.vdc_ids()
+            if vdc_ids:
+                vms = itertools.chain.from_iterable(self.get_vms_by_vdc(vdc_id) for vdc_id in vdc_ids)
             else:
                 vms = self.get_vms()
 
-            for vm in vms:
-                self.update_vm_disks_and_nics(vm)
-                self.update_vm_template(vm)
-                get_md = self.find_boolean_config_value("ABIQUO_INV_GET_METADATA", "get_metadata")
-                if get_md:
-                    self.update_vm_metadata(vm)
-
-                host_vars = self.vars_from_json(vm.json)
-
-                hw_profile = ''
-                for link in vm.links:
-                    if link['rel'] == 'virtualappliance':
-                        vm_vapp = link['title'].replace('[','').replace(']','').replace(' ','_')
-                    elif link['rel'] == 'virtualdatacenter':
-                        vm_vdc = link['title'].replace('[','').replace(']','').replace(' ','_')
-                    elif link['rel'] == 'virtualmachinetemplate':
-                        vm_template = link['title'].replace('[','').replace(']','').replace(' ','_')
-                    elif link['rel'] == 'hardwareprofile':
-                        hw_profile = link['title'].replace('[','').replace(']','').replace(' ','_')
-
-                # From abiquo.ini: Only adding to inventory VMs with public IP
-                public_ip_only = self.find_boolean_config_value("ABIQUO_INV_PUBLIC_IP_ONLY", "public_ip_only")
-                default_net_iface= self.find_config_value("ABIQUO_INV_DEFAULT_IFACE", "default_net_interface")
-
-                vm_nic = None
-                for nic in vm.nics:
-                    for link in nic['links']:
-                        if public_ip_only:
-                            if link['type'] == 'application/vnd.abiquo.publicip+json' and link['rel']== 'ip':
-                                vm_nic = link['title']
-                                break
-                        # Otherwise, assigning defined network interface IP address
-                        else:
-                            if link['rel'] == default_net_iface:
-                                vm_nic = link['title']
-                                break
-
-                if vm_nic is None:
-                    continue
-
-                vm_state = True
-                # From abiquo.ini: Only adding to inventory VMs deployed
-                deployed_only = self.find_boolean_config_value("ABIQUO_INV_DEPLOYED_ONLY", "deployed_only")
-                if deployed_only and vm.state == 'NOT_ALLOCATED':
-                    vm_state = False
-
-                if not vm_state:
-                    continue
-
-                # Retrieve network names the VM is connected to
-                network_names = self.get_vm_network_names(vm)
-
-                # Retrieve DS tiers the VM is using
-                ds_tier_names = self.get_vm_ds_tiers_names(vm)
-
-                # Retrieve Firewall names
-                firewall_names = self.get_vm_firewall_names(vm)
-
-                # Retrieve LoadBalancer names
-                loadbalancer_names = self.get_vm_loadbalancer_names(vm)
-
-                ## Set host vars
-                if 'fqdn' in vm.json:
-                    dest = vm.fqdn
-                elif 'label' in vm.json:
-                    dest = vm.label.replace('[','').replace(']','').replace(' ','_')
-                else:
-                    dest = vm.name.replace('[','').replace(']','').replace(' ','_')
-
-                host_vars['ansible_host'] = vm_nic
-                host_vars['ansible_user'] = vm.template['loginUser'] if 'loginUser' in vm.template else ''
-                inventory['_meta']['hostvars'][dest] = host_vars
-
-                ## Start with groupings
-
-                # VM name
-                if vm.name not in inventory:
-                    inventory[vm.name] = []
-                inventory[vm.name].append(dest)
-
-                # VM template
-                vm_tmpl = "template_%s" % vm_template
-                if vm_tmpl not in inventory:
-                    inventory[vm_tmpl] = []
-                inventory[vm_tmpl].append(dest)
-
-                # vApp
-                vapp = "vapp_%s" % vm_vapp
-                if vapp not in inventory:
-                    inventory[vapp] = []
-                inventory[vapp].append(dest)
-
-                # VDC
-                vdc = "vdc_%s" % vm_vdc
-                if vdc not in inventory:
-                    inventory[vdc] = []
-                inventory[vdc].append(dest)
-
-                # VDC_vApp
-                vdcvapp = 'vdc_%s_vapp_%s' % (vm_vdc, vm_vapp)
-                if vdcvapp not in inventory:
-                    inventory[vdcvapp] = []
-                inventory[vdcvapp].append(dest)
-
-                # HW profiles
-                if hw_profile != '':
-                    hwprof = 'hwprof_%s' % hw_profile
-                    if hwprof not in inventory:
-                        inventory[hwprof] = []
-                    inventory[hwprof].append(dest)
-
-                # VM variables
-                if 'variables' in vm.json:
-                    for var in vm.json['variables']:
-                        var_sane = self.sanitize_name(var)
-                        val_sane = self.sanitize_name(vm.json['variables'][var])
-                        vargroup = "var_%s_%s" % (var_sane, val_sane)
-                        if vargroup not in inventory:
-                            inventory[vargroup] = []
-                        inventory[vargroup].append(dest)
-                
-                # Networks names
-                for name in network_names:
-                    name_sane = self.sanitize_name(name)
-                    net_key = "network_%s" % name_sane
-                    if net_key not in inventory:
-                        inventory[net_key] = []
-                    inventory[net_key].append(dest)
-
-                # DS Tier names
-                for name in ds_tier_names:
-                    name_sane = self.sanitize_name(name)
-                    tier_key = "dstier_%s" % name_sane
-                    if tier_key not in inventory:
-                        inventory[tier_key] = []
-                    inventory[tier_key].append(dest)
-                
-                # Firewall names
-                for name in firewall_names:
-                    name_sane = self.sanitize_name(name)
-                    fw_key = "firewall_%s" % name_sane
-                    if fw_key not in inventory:
-                        inventory[fw_key] = []
-                    inventory[fw_key].append(dest)
-
-                # Loadbalancer names
-                for name in loadbalancer_names:
-                    name_sane = self.sanitize_name(name)
-                    lb_key = "loadbalancer_%s" % name_sane
-                    if lb_key not in inventory:
-                        inventory[lb_key] = []
-                    inventory[lb_key].append(dest)
+            # Only VMs that are new or changed since the last refresh get
+            # enriched again. VMs that are gone are not carried over.
+            previous = self.get_snapshot() if incremental else {}
+            snapshot = {}
+
+            # Enrichment runs concurrently, but hosts are added in listing
+            # order so the output matches a sequential run.
+            for key, entry, status in self.map_vms(lambda vm: self.refresh_vm(vm, previous, last_known_host), vms):
+                snapshot[key] = entry
+                if status is not None:
+                    counts[status] += 1
+                if entry['host'] is not None:
+                    vm_hosts[key] = entry['host']['dest']
+                    with self.timed('grouping'):
+                        self.add_host_to_inventory(inventory, entry['host'])
+            self.finish_groups(inventory)
+            self.check_failures(counts)
+
+            if incremental:
+                self.save_snapshot(snapshot)
 
             return inventory
-        except Exception:
-            # Return empty hosts output
-            sys.stderr.write(traceback.format_exc())
-            return self._empty_inventory()
+        except Exception as e:
+            # Failing keeps the previous cache instead of replacing it with
+            # an empty inventory
+            self.fail_with_error(e)
+        finally:
+            self.templates.save()
+            if os.environ.get('ABQ_DEBUG'):
+                sys.stderr.write("API response memo: %d hits, %d misses\n" % (self.responses.hits, self.responses.misses))
+
+    def get_vm(self, href):
+        ''' GETs a single VM, returns None if it does not exist '''
+        from abiquo.client import Abiquo
+        code, vm = self.api_get(Abiquo(href, auth=self.api.auth, verify=self.api.verify), 'virtualmachines',
+                                headers={'accept': 'application/vnd.abiquo.virtualmachine+json'})
+        if code == 404:
+            return None
+        check_response(200, code, vm)
+        return vm
+
+    def patch_inventory(self, inventory, vm_hosts, href):
+        ''' Enriches the VM at href again and replaces its host in a finished inventory
+
+        Returns False if the VM was not in the inventory and still is not.
+        '''
+        # Sub-resources may have changed since they were last requested
+        self.responses = ResponseMemo()
+        vm = self.get_vm(href)
+        host = self.process_vm(vm) if vm is not None else None
+
+        dest = vm_hosts.pop(href, None)
+        if dest is not None:
+            self.remove_host_from_inventory(inventory, dest)
+        if host is None:
+            return dest is not None
+
+        self.remove_host_from_inventory(inventory, host['dest'])
+        self.append_host_to_inventory(inventory, host)
+        vm_hosts[href] = host['dest']
+        return True
+
+    def event_vm_href(self, line):
+        ''' URL of the VM changed by an event stream line
+
+        None if it is not a VM lifecycle event, or the VM is not in one of
+        the virtual datacenters listed.
+        '''
+        if line.startswith('data:'):
+            line = line[len('data:'):]
+        try:
+            event = json.loads(line)
+        except ValueError:
+            # Empty lines, comments and event names of server-sent events
+            return None
+
+        if not isinstance(event, dict) or event.get('type') != 'VIRTUAL_MACHINE' \
+                or event.get('action') not in VM_EVENT_ACTIONS or not event.get('entityIdentifier'):
+            return None
+        href = event['entityIdentifier']
+        if href.startswith('/'):
+            href = self.api.url.rstrip('/') + href
+        vdc_ids = self.vdc_ids()
+        if vdc_ids and not any('/virtualdatacenters/%s/' % vdc_id in href for vdc_id in vdc_ids):
+            return None
+        return href
+
+    def watch_events(self, events):
+        ''' Puts the URL of every VM changed by an event into the events queue
+
+        Runs forever, reconnecting to the event stream when it is closed.
+        None is queued after reconnecting, as events may have been missed.
+        '''
+        self.prepare_refresh()
+        # Single VMs are cheaper to enrich one by one than with their VDC
+        self.vdc_indexes = None
+        connected = False
+        while True:
+            try:
+                response = self.session.get(self.events_url(), auth=self.api.auth, verify=self.api.verify,
+                                            headers={'accept': 'text/event-stream'}, stream=True,
+                                            timeout=(30, None))
+                if response.status_code != 200:
+                    raise IOError('Event stream answered %d' % response.status_code)
+                if connected:
+                    events.put(None)
+                connected = True
+                # Events are small and far apart, read them as soon as they arrive
+                for line in response.iter_lines(chunk_size=1, decode_unicode=True):
+                    href = self.event_vm_href(line) if line else None
+                    if href is not None:
+                        events.put(href)
+                response.close()
+            except Exception:
+                sys.stderr.write(traceback.format_exc())
+            time.sleep(random.uniform(1, 5))
+
+    def apply_events(self, source, sources, events):
+        ''' Applies the VMs queued by a watcher of source to the inventory served '''
+        while True:
+            # Events arriving together, like those of a vApp deploy, are
+            # applied at once and the cache is only saved after them
+            batch = [events.get()]
+            while not events.empty():
+                batch.append(events.get())
+            with self.serving:
+                try:
+                    if None in batch:
+                        source.inventory = source.reload_inventory()
+                        self.serve_sources(sources)
+                    else:
+                        changed = False
+                        for href in OrderedDict.fromkeys(batch):
+                            changed = self.watchers[source].patch_inventory(source.inventory, source.vm_hosts,
+                                                                            href) or changed
+                        if not changed:
+                            continue
+                        self.serve_sources(sources)
+                        if source.cache_enabled():
+                            # Saved under the lock like refreshes, so a
+                            # --refresh-cache or --refresh-scope run in
+                            # progress does not overwrite it afterwards
+                            lock = source.lock_cache(blocking=True)
+                            try:
+                                source.save_cache(source.inventory)
+                            finally:
+                                if lock is not None:
+                                    lock.close()
+                except (Exception, SystemExit):
+                    # The next reconcile brings the inventory up to date
+                    sys.stderr.write(traceback.format_exc())
+
+    def load_sources(self, sources, load):
+        ''' Loads the inventory of every source with load and serves them '''
+        with self.serving:
+            for source, inv in zip(sources, self.map_sources(load, sources)):
+                source.inventory = inv
+                # Refreshes save them to the cache too, which may be all
+                # there is when the inventory was loaded from it
+                if source.cache_enabled():
+                    source.vm_hosts = source.get_cached_vm_hosts()
+            self.serve_sources(sources)
+
+    def serve_sources(self, sources):
+        inv = self.merge_inventories([source.inventory for source in sources])
+        self.served, self.served_list = inv, self.render(inv)
+
+    def query_daemon(self):
+        ''' Writes the output served by a running daemon, returns False if there is none '''
+        path = self.daemon_socket()
+        if not os.path.exists(path):
+            return False
+
+        try:
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.settimeout(30)
+            client.connect(path)
+            client.sendall(json.dumps({'host': self.args.host}).encode('utf-8') + b'\n')
+            chunks = []
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            client.close()
+        except (IOError, OSError):
+            return False
+
+        if not chunks:
+            return False
+        sys.stdout.write(b''.join(chunks).decode('utf-8'))
+        return True
+
+    def serve(self):
+        ''' Serves --list and --host over a Unix socket, refreshing the inventory in the background '''
+        import signal
+        import socketserver
+
+        path = self.daemon_socket()
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                probe.close()
+                raise SystemExit("An inventory daemon is already listening on %s" % path)
+            except (IOError, OSError):
+                # Left behind by a daemon that did not shut down cleanly
+                os.unlink(path)
+
+        inventory = self
+        sources = self.sources() or [self]
+        self.serving = threading.Lock()
+        self.load_sources(sources, lambda source: source.load_inventory())
+        # Refresh when the oldest source cache expires, or right away if one
+        # was served stale while a background process refreshes it
+        ages = [(source.loaded_cache_age(), source.cache_ttl()) for source in sources]
+        age = max(source_age for source_age, ttl in ages)
+        stale = any(source_age > ttl for source_age, ttl in ages)
+        # With events, the periodic refresh only reconciles missed changes
+        interval = self.reconcile_interval() if self.events_enabled() else self.cache_ttl()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode('utf-8'))
+                except ValueError:
+                    return
+                if request.get('host'):
+                    output = inventory.render(inventory.served, request['host'])
+                else:
+                    output = inventory.served_list
+                self.wfile.write(output.encode('utf-8'))
+
+        def refresh():
+            refreshed = time.time() - (interval if stale else age)
+            # The cache served stale is read again once it is revalidated,
+            # instead of refreshing it a second time
+            load = (lambda source: source.load_revalidated_inventory()) if stale else None
+            while True:
+                time.sleep(max(refreshed + interval - time.time(), 1))
+                refreshed = time.time()
+                try:
+                    self.load_sources(sources, load or (lambda source: source.reload_inventory()))
+                    load = None
+                except (Exception, SystemExit):
+                    # Keep serving the previous inventory until the next refresh
+                    sys.stderr.write(traceback.format_exc())
+
+        threads = [threading.Thread(target=refresh)]
+        if self.events_enabled():
+            # Each source has a copy of its own following its event stream,
+            # so it does not share API clients with the refreshes
+            self.watchers = dict((source, copy.copy(source)) for source in sources)
+            for source in sources:
+                events = queue.Queue()
+                threads.append(threading.Thread(target=self.watchers[source].watch_events, args=(events,)))
+                threads.append(threading.Thread(target=self.apply_events, args=(source, sources, events)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        server.daemon_threads = True
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(path)
 
 if __name__ == '__main__':
     AbiquoInventory()
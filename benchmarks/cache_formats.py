@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compares the cache formats on a synthetic inventory: time to save it, size
+# on disk, time to load it for --list and time to look up a single host.
+#
+# Usage: python benchmarks/cache_formats.py [--hosts N] [--runs N]
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import configparser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from abiquo_inventory import AbiquoInventory, cache_formats
+
+def synthetic_host_vars(i):
+    host_vars = {'ansible_host': '10.0.%d.%d' % (i // 250, i % 250), 'ansible_user': 'root'}
+    # Roughly what vars_from_json produces for a VM with two NICs and disks
+    for seq in range(2):
+        host_vars.update({
+            'abq_nic%d_ip' % seq: '10.%d.%d.%d' % (seq, i // 250, i % 250),
+            'abq_nic%d_mac' % seq: '52:54:00:%02x:%02x:%02x' % (seq, i // 256 % 256, i % 256),
+            'abq_nic%d_net_type' % seq: 'privatenetwork',
+            'abq_disk%d_sizeInMb' % seq: 10240 * (seq + 1),
+            'abq_disk%d_tier' % seq: 'Default Tier %d' % seq,
+        })
+    host_vars['abq_variables'] = {'role': ['web', 'db', 'cache'][i % 3], 'env': 'production'}
+    return host_vars
+
+def synthetic_inventory(hosts):
+    inv = {'_meta': {'hostvars': {}}}
+    for i in range(hosts):
+        name = 'vm_%d' % i
+        inv['_meta']['hostvars'][name] = synthetic_host_vars(i)
+        for group in ['ABQ_%d' % i, 'vdc_%d' % (i % 10), 'vapp_%d' % (i % 50),
+                      'template_%d' % (i % 7), 'network_%d' % (i % 10)]:
+            inv.setdefault(group, []).append(name)
+    return inv
+
+def best_of(runs, func):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare cache formats')
+    parser.add_argument('--hosts', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    inv = synthetic_inventory(args.hosts)
+    inventory = AbiquoInventory.__new__(AbiquoInventory)
+    inventory.config = configparser.ConfigParser()
+    os.environ['ABIQUO_INV_CACHE_DIR'] = tempfile.mkdtemp(prefix='abiquo-bench-')
+
+    print('hosts: %d, best of %d runs' % (args.hosts, args.runs))
+    print('%-10s %10s %10s %10s %10s' % ('format', 'save', 'size', '--list', '--host'))
+    for name in sorted(cache_formats()):
+        os.environ['ABIQUO_INV_CACHE_FORMAT'] = name
+        save = best_of(args.runs, lambda: inventory.save_cache(inv))
+        size = os.stat(inventory.cache_file()).st_size
+        assert inventory.get_cache() == inv
+        load = best_of(args.runs, inventory.get_cache)
+        host = best_of(args.runs, lambda: inventory.get_cached_host('vm_%d' % (args.hosts // 2)))
+        print('%-10s %8.1fms %8.1fMB %8.1fms %8.2fms' % (name, save, size / 1048576.0, load, host))
+
+if __name__ == '__main__':
+    main()
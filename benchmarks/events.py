@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Runs the inventory daemon with events enabled against the local stand-in
+# API, then deploys, undeploys, reconfigures, deletes and creates VMs on it.
+# For each change, reports how long the daemon took to serve it and the API
+# requests it made. Only three of the four virtual datacenters are listed,
+# so a VM created in the other one must be left out. Finally checks that
+# the patched inventory, and the cache, match a full refresh, exiting with
+# an error if they do not.
+#
+# Usage: python benchmarks/events.py [--vms N] [--latency SECONDS]
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_api import MockAbiquo
+
+def query(path):
+    ''' --list output of the daemon listening on path, None if it is not up '''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        client.sendall(b'{"host": null}\n')
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except (IOError, OSError):
+        return None
+    finally:
+        client.close()
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+def membership(inv):
+    ''' Hosts with their vars and groups, regardless of order '''
+    groups = {}
+    for group, hosts in inv.items():
+        if group != '_meta':
+            for host in hosts:
+                groups.setdefault(host, set()).add(group)
+    return dict((host, (host_vars, groups.get(host, set()))) for host, host_vars in inv['_meta']['hostvars'].items())
+
+def main():
+    parser = argparse.ArgumentParser(description='Apply VM events to the inventory daemon on a local stand-in API')
+    parser.add_argument('--vms', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every API response (default: 0)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='abiquo-bench-')
+    script = os.path.join(workdir, 'abiquo_inventory.py')
+    shutil.copy(os.path.join(ROOT, 'abiquo_inventory.py'), workdir)
+    with open(os.path.join(workdir, 'abiquo_inventory.ini'), 'w') as config:
+        config.write('[defaults]\ndefault_net_interface = nic0\ndeployed_only = true\n'
+                     'vdc = 1, 2, 3\n[cache]\ncache_dir = %s\n[events]\nenabled = true\n' % workdir)
+    path = os.path.join(workdir, 'abiquo-inventory.sock')
+
+    mock = MockAbiquo(args.vms, latency=args.latency).start()
+    env = dict(os.environ, ABIQUO_API_URL=mock.url, ABIQUO_API_USERNAME='admin', ABIQUO_API_PASSWORD='xabiquo')
+    # Every VM but one in five is deployed, and VM i is in virtual datacenter i % 4 + 1
+    new = args.vms + 1 if (args.vms + 1) % 5 else args.vms + 2
+    outside = new + 1 if (new + 1) % 5 else new + 2
+    # Change, and whether the daemon serves it yet
+    changes = [
+        ('undeploy', lambda: mock.set_vm_state(1, 'NOT_ALLOCATED'),
+         lambda inv: 'vm1.example.com' not in inv['_meta']['hostvars']),
+        ('deploy', lambda: mock.set_vm_state(5, 'ON'),
+         lambda inv: 'vm5.example.com' in inv['_meta']['hostvars']),
+        ('reconfigure', lambda: mock.reconfigure_vm(2, variables={'role': 'api', 'env': 'production'}),
+         lambda inv: 'vm2.example.com' in inv.get('var_role_api', [])),
+        ('delete', lambda: mock.delete_vm(4),
+         lambda inv: 'vm4.example.com' not in inv['_meta']['hostvars']),
+        ('create', lambda: mock.create_vm(new),
+         lambda inv: 'vm%d.example.com' % new in inv['_meta']['hostvars']),
+        # Events are applied in order, so once the reconfigure is served
+        # the VM in the unlisted virtual datacenter has been skipped
+        ('other vdc', lambda: (mock.create_vm(outside, vdc=4),
+                               mock.reconfigure_vm(2, variables={'role': 'web'})),
+         lambda inv: 'vm2.example.com' in inv.get('var_role_web', [])),
+    ]
+
+    daemon = subprocess.Popen([sys.executable, script, '--daemon'], env=env,
+                              stderr=open(os.path.join(workdir, 'daemon.log'), 'w'))
+    try:
+        start = time.time()
+        while query(path) is None:
+            if daemon.poll() is not None or time.time() - start > 600:
+                raise SystemExit('The daemon did not start, see %s' % os.path.join(workdir, 'daemon.log'))
+            time.sleep(0.1)
+        print('VMs: %d, latency: %.3fs, daemon started in %.2fs with %d requests'
+              % (args.vms, args.latency, time.time() - start, mock.requests))
+        # Let the daemon connect to the event stream
+        time.sleep(1)
+
+        print('%-12s %10s %10s' % ('event', 'applied', 'requests'))
+        for label, change, applied in changes:
+            requests = mock.requests
+            start = time.time()
+            change()
+            while not applied(query(path)):
+                if time.time() - start > 60:
+                    raise SystemExit('%s was not applied, see %s' % (label, os.path.join(workdir, 'daemon.log')))
+                time.sleep(0.01)
+            print('%-12s %9.3fs %10d' % (label, time.time() - start, mock.requests - requests))
+
+        served = membership(query(path))
+        failures = []
+        if 'vm%d.example.com' % outside in served:
+            failures.append('the VM created in an unlisted virtual datacenter is served')
+        refresh_env = dict(env, ABIQUO_INV_CACHE_DISABLE='1', ABIQUO_INV_DAEMON_SOCKET=os.path.join(workdir, 'none'))
+        requests = mock.requests
+        refreshed = membership(json.loads(subprocess.check_output([sys.executable, script, '--refresh-cache'],
+                                                                  env=refresh_env)))
+        print('full refresh: %d requests, same as served: %s' % (mock.requests - requests, served == refreshed))
+        if served != refreshed:
+            failures.append('the inventory served differs from a full refresh')
+        cache_env = dict(env, ABIQUO_INV_DAEMON_SOCKET=os.path.join(workdir, 'none'))
+        cached = membership(json.loads(subprocess.check_output([sys.executable, script], env=cache_env)))
+        print('cache same as served: %s' % (cached == served))
+        if cached != served:
+            failures.append('the cache differs from the inventory served')
+        if failures:
+            raise SystemExit('FAILED: %s' % '; '.join(failures))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        mock.stop()
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
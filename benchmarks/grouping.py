@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Measures the CPU time spent turning VMs into host entries and groups,
+# without any HTTP: the VMs and their NICs, disks, volumes and templates
+# come straight from the stand-in API data.
+#
+# Usage: python benchmarks/grouping.py [--vms N] [--runs N]
+
+import os
+import sys
+import time
+import argparse
+import configparser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from abiquo.client import ObjectDto
+from abiquo_inventory import AbiquoInventory
+from mock_api import MockAbiquo
+
+class OfflineInventory(AbiquoInventory):
+    ''' Inventory answering API requests from the stand-in data '''
+    def __init__(self, mock):
+        self.mock = mock
+        self.profiler = None
+        self.config = configparser.ConfigParser()
+        self.config.read_dict({'defaults': {'default_net_interface': 'nic0', 'deployed_only': 'true'},
+                               'api': {'workers': '1'}, 'cache': {'use_cache': 'false'}})
+
+    def init_client(self):
+        pass
+
+    def get_vms(self):
+        return [ObjectDto(item['vm']) for item in self.mock.vms]
+
+    def follow(self, dto, rel):
+        link = dto._extract_link(rel)
+        return 200, ObjectDto(self.mock.resources[link['href'][len(self.mock.url):]])
+
+def main():
+    parser = argparse.ArgumentParser(description='Time host entries and grouping for N VMs')
+    parser.add_argument('--vms', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    mock = MockAbiquo(args.vms)
+    mock.server.server_close()
+
+    times = []
+    for _ in range(args.runs):
+        inventory = OfflineInventory(mock)
+        start = time.process_time()
+        inv = inventory.refresh_inventory()
+        times.append(time.process_time() - start)
+
+    print('VMs: %d, hosts: %d, groups: %d' % (args.vms, len(inv['_meta']['hostvars']), len(inv) - 1))
+    print('CPU time: best %.3fs, worst %.3fs' % (min(times), max(times)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local stand-in for the parts of the Abiquo API used by the inventory
+# script. It generates N synthetic VMs spread across virtual datacenters,
+# virtual appliances and templates, with NICs on private and public
+# networks, hard disks, volumes, metadata, variables and datastore tier,
+# firewall and load balancer links. Volumes and private networks, with their
+# IPs, are also listed per virtual datacenter, and VMs per virtual
+# datacenter and virtual appliance. VMs can be created, deployed, undeployed,
+# reconfigured and deleted, publishing their events on the /m/stream event
+# stream.
+#
+# Usage: python benchmarks/mock_api.py [--vms N] [--port PORT] [--latency SECONDS]
+#                                      [--failure-rate RATE]
+
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+
+try:
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+MEDIA_TYPE = 'application/vnd.abiquo.%s+json'
+
+class MockAbiquo(object):
+    ''' Serves synthetic VMs over HTTP, counting the requests it receives '''
+    def __init__(self, vms, port=0, latency=0.0, failure_rate=0.0, vdcs=4, vapps=8, templates=10):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/api' % self.server.server_address[1]
+        self.resources = {}
+        self.collections = {}
+        self.vms = []
+        self.subscribers = []
+        for template in range(1, templates + 1):
+            self.add_template(template)
+        for vdc in range(1, vdcs + 1):
+            self.add_vdc(vdc)
+        for i in range(1, vms + 1):
+            self.add_vm(i, (i % vdcs) + 1, (i % vapps) + 1, (i % templates) + 1)
+
+    def link(self, rel, path, media=None, title=None):
+        link = {'rel': rel, 'href': self.url + path}
+        if media is not None:
+            link['type'] = MEDIA_TYPE % media
+        if title is not None:
+            link['title'] = title
+        return link
+
+    def add_template(self, template):
+        path = '/admin/enterprises/1/datacenterrepositories/1/virtualmachinetemplates/%d' % template
+        self.resources[path] = {
+            'id': template, 'name': 'Template %d' % template, 'loginUser': 'user%d' % template,
+            'cpuRequired': 1, 'ramRequired': 1024, 'diskFileSize': 10737418240,
+            'links': [self.link('edit', path, 'virtualmachinetemplate')],
+        }
+
+    def add_vdc(self, vdc):
+        path = '/cloud/virtualdatacenters/%d' % vdc
+        network = '%s/privatenetworks/%d' % (path, vdc)
+        self.collections.setdefault('/cloud/virtualdatacenters', []).append({
+            'id': vdc, 'name': 'VDC %d' % vdc, 'links': [self.link('edit', path, 'virtualdatacenter')],
+        })
+        self.collections[path + '/privatenetworks'] = [{
+            'id': vdc, 'name': 'Private network %d' % vdc, 'address': '10.%d.0.0' % vdc, 'mask': 16,
+            'links': [self.link('edit', network, 'vlan'), self.link('ips', network + '/ips', 'privateips')],
+        }]
+        self.collections[network + '/ips'] = []
+        self.collections[path + '/volumes'] = []
+
+    def add_vm(self, i, vdc, vapp, template):
+        vapp_path = '/cloud/virtualdatacenters/%d/virtualappliances/%d' % (vdc, vapp)
+        path = '%s/virtualmachines/%d' % (vapp_path, i)
+        self.resources.setdefault(vapp_path, {
+            'id': vapp, 'name': '[App] %d' % vapp, 'links': [self.link('edit', vapp_path, 'virtualappliance')],
+        })
+        network_path = '/cloud/virtualdatacenters/%d/privatenetworks/%d' % (vdc, vdc)
+        private_ip = '10.%d.%d.%d' % (vdc, i // 250, i % 250)
+        private_ip_path = '%s/ips/%d' % (network_path, i)
+        mac = '52:54:00:%02x:%02x:%02x' % (vdc, i // 256 % 256, i % 256)
+        tier = 'Tier %d' % (i % 3)
+
+        nics = [{
+            'sequence': 0, 'ip': private_ip, 'mac': mac,
+            'links': [
+                self.link('privatenetwork', network_path, 'vlan', 'Private network %d' % vdc),
+                self.link('nic0', private_ip_path, 'privateip', private_ip),
+                self.link('ip', private_ip_path, 'privateip', private_ip),
+            ],
+        }]
+        links = [
+            self.link('edit', path, 'virtualmachine'),
+            self.link('virtualdatacenter', '/cloud/virtualdatacenters/%d' % vdc, 'virtualdatacenter', 'VDC %d' % vdc),
+            self.link('virtualappliance', '/cloud/virtualdatacenters/%d/virtualappliances/%d' % (vdc, vapp),
+                      'virtualappliance', '[App] %d' % vapp),
+            self.link('virtualmachinetemplate',
+                      '/admin/enterprises/1/datacenterrepositories/1/virtualmachinetemplates/%d' % template,
+                      'virtualmachinetemplate', 'Template %d' % template),
+            self.link('hardwareprofile', '/admin/datacenters/1/hardwareprofiles/%d' % (i % 4 + 1), 'hardwareprofile',
+                      'Profile %d' % (i % 4 + 1)),
+            self.link('nics', path + '/network/nics', 'nics'),
+            self.link('harddisks', path + '/storage/disks', 'harddisks'),
+            self.link('volumes', path + '/storage/volumes', 'volumes'),
+            self.link('metadata', path + '/metadata', 'metadata'),
+            self.link('datastoretier0', '/cloud/locations/1/datastoretiers/%d' % (i % 3 + 1), 'datastoretier', tier),
+            self.link('nic0', private_ip_path, 'privateip', private_ip),
+        ]
+        if i % 3 == 0:
+            public_ip = '85.%d.%d.%d' % (vdc, i // 250, i % 250)
+            public_ip_path = '/cloud/virtualdatacenters/%d/publicips/purchased/%d' % (vdc, i)
+            nics.append({
+                'sequence': 1, 'ip': public_ip,
+                'links': [
+                    self.link('publicnetwork', '/cloud/locations/1/publicnetworks/1', 'vlan', 'Public network'),
+                    self.link('nic1', public_ip_path, 'publicip', public_ip),
+                    self.link('ip', public_ip_path, 'publicip', public_ip),
+                ],
+            })
+            links.append(self.link('nic1', public_ip_path, 'publicip', public_ip))
+        if i % 4 == 0:
+            links.append(self.link('firewall', '/cloud/locations/1/firewalls/%d' % (i % 2 + 1), 'firewallpolicy',
+                                   'Firewall %d' % (i % 2 + 1)))
+        if i % 6 == 0:
+            links.append(self.link('loadbalancer', '/cloud/locations/1/loadbalancers/1', 'loadbalancer',
+                                   'Load balancer'))
+
+        vm = {
+            'id': i, 'name': 'ABQ_%08d' % i, 'label': 'vm %d' % i, 'uuid': '00000000-0000-0000-0000-%012d' % i,
+            'cpu': 1 + i % 4, 'ram': 1024 * (1 + i % 4), 'fqdn': 'vm%d.example.com' % i,
+            'state': 'NOT_ALLOCATED' if i % 5 == 0 else 'ON',
+            'variables': {'role': ['web', 'db', 'cache'][i % 3], 'env': 'production'},
+            'links': links,
+        }
+        disks = [{'sequence': 0, 'sizeInMb': 10240, 'bootable': True,
+                  'links': [self.link('datastoretier', '/cloud/locations/1/datastoretiers/%d' % (i % 3 + 1),
+                                      'datastoretier', tier)]}]
+        volumes = []
+        if i % 2:
+            volume_path = '/cloud/virtualdatacenters/%d/volumes/%d' % (vdc, i)
+            volumes.append({'sequence': 1, 'sizeInMB': 20480, 'name': 'volume %d' % i,
+                            'links': [self.link('edit', volume_path, 'volume'),
+                                      self.link('tier', '/cloud/locations/1/tiers/1', 'tier', 'Volume tier'),
+                                      self.link('virtualmachine', path, 'virtualmachine', vm['name'])]})
+            self.collections['/cloud/virtualdatacenters/%d/volumes' % vdc].extend(volumes)
+
+        private_ip_resource = {
+            'id': i, 'ip': private_ip, 'mac': mac, 'available': False,
+            'links': [self.link('edit', private_ip_path, 'privateip'),
+                      self.link('privatenetwork', network_path, 'vlan', 'Private network %d' % vdc),
+                      self.link('virtualmachine', path, 'virtualmachine', vm['name'])],
+        }
+        self.collections[network_path + '/ips'].append(private_ip_resource)
+        self.resources[private_ip_path] = private_ip_resource
+
+        self.vms.append({'vm': vm, 'vdc': vdc, 'vapp': vapp})
+        self.resources[path] = vm
+        self.resources[path + '/network/nics'] = {'collection': nics, 'links': [], 'totalSize': len(nics)}
+        self.resources[path + '/storage/disks'] = {'collection': disks, 'links': [], 'totalSize': len(disks)}
+        self.resources[path + '/storage/volumes'] = {'collection': volumes, 'links': [], 'totalSize': len(volumes)}
+        self.resources[path + '/metadata'] = {'metadata': {'monitoring': {'enabled': i % 2 == 0}}, 'links': []}
+
+    def vm_path(self, i):
+        for item in self.vms:
+            if item['vm']['id'] == i:
+                return '/cloud/virtualdatacenters/%d/virtualappliances/%d/virtualmachines/%d' % (
+                    item['vdc'], item['vapp'], i)
+        raise KeyError(i)
+
+    def publish(self, action, path):
+        ''' Sends a VM event to every client of the event stream '''
+        event = {'id': random.randint(1, 2 ** 31), 'timestamp': int(time.time() * 1000), 'user': 'admin',
+                 'enterprise': 'Abiquo', 'severity': 'INFO', 'source': 'ABIQUO_SERVER', 'action': action,
+                 'type': 'VIRTUAL_MACHINE', 'entityIdentifier': path}
+        with self.lock:
+            for events in self.subscribers:
+                events.put(event)
+
+    def create_vm(self, i, vdc=1, vapp=1, template=1):
+        with self.lock:
+            self.add_vm(i, vdc, vapp, template)
+        self.publish('CREATE', self.vm_path(i))
+
+    def set_vm_state(self, i, state):
+        path = self.vm_path(i)
+        self.resources[path]['state'] = state
+        self.publish('UNDEPLOY_FINISH' if state == 'NOT_ALLOCATED' else 'DEPLOY_FINISH', path)
+
+    def reconfigure_vm(self, i, **attributes):
+        path = self.vm_path(i)
+        self.resources[path].update(attributes)
+        self.publish('RECONFIGURE', path)
+
+    def delete_vm(self, i):
+        path = self.vm_path(i)
+        href = self.url + path
+        with self.lock:
+            self.vms = [item for item in self.vms if item['vm']['id'] != i]
+            for resource in [resource for resource in self.resources
+                             if resource == path or resource.startswith(path + '/')]:
+                del self.resources[resource]
+            for name, items in self.collections.items():
+                items[:] = [item for item in items
+                            if not any(link['href'] == href for link in item['links'] if link['rel'] == 'virtualmachine')]
+        self.publish('DELETE', path)
+
+    def vm_listing(self, path, query):
+        items = self.vms
+        parts = path.split('/')
+        if path.endswith('/action/virtualmachines'):
+            vdc = int(parts[3])
+            items = [item for item in items if item['vdc'] == vdc]
+        elif path.endswith('/virtualmachines') and len(parts) == 7 and parts[4] == 'virtualappliances':
+            vdc, vapp = int(parts[3]), int(parts[5])
+            items = [item for item in items if item['vdc'] == vdc and item['vapp'] == vapp]
+        elif path != '/cloud/virtualmachines':
+            return None
+        return self.page(path, [item['vm'] for item in items], query)
+
+    def page(self, path, items, query):
+        total = len(items)
+        startwith = int(query.get('startwith', ['0'])[0])
+        limit = int(query.get('limit', ['25'])[0])
+        links = []
+        if startwith + limit < total:
+            links.append(self.link('next', '%s?startwith=%d&limit=%d' % (path, startwith + limit, limit)))
+        return {'collection': items[startwith:startwith + limit], 'links': links, 'totalSize': total}
+
+    def get(self, path, query):
+        if path in self.resources:
+            return self.resources[path]
+        if path in self.collections:
+            return self.page(path, self.collections[path], query)
+        return self.vm_listing(path, query)
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, do not let Nagle's
+            # algorithm delay the body on kept-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with mock.lock:
+                    mock.requests += 1
+                if mock.latency:
+                    time.sleep(mock.latency)
+
+                if mock.failure_rate and random.random() < mock.failure_rate:
+                    with mock.lock:
+                        mock.failures += 1
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                url = urlparse(self.path)
+                if url.path == '/m/stream':
+                    return self.stream_events()
+                body = mock.get(url.path[len('/api'):], parse_qs(url.query))
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def stream_events(self):
+                ''' Server-sent events, one JSON event per data line, until the client leaves '''
+                events = queue.Queue()
+                with mock.lock:
+                    mock.subscribers.append(events)
+                self.close_connection = True
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                try:
+                    while True:
+                        try:
+                            event = events.get(timeout=15)
+                        except queue.Empty:
+                            self.wfile.write(b': keepalive\n\n')
+                            continue
+                        self.wfile.write(b'data: ' + json.dumps(event).encode('utf-8') + b'\n\n')
+                except (IOError, OSError):
+                    pass
+                finally:
+                    with mock.lock:
+                        mock.subscribers.remove(events)
+
+        return Handler
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Abiquo API')
+    parser.add_argument('--vms', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=8009)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every response')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with a 503')
+    args = parser.parse_args()
+
+    mock = MockAbiquo(args.vms, port=args.port, latency=args.latency, failure_rate=args.failure_rate)
+    print('Serving %d VMs on %s' % (args.vms, mock.url))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local stand-in for a Redis server, implementing the commands used by the
+# community.general.redis cache plugin (strings with expiry and the sorted
+# set of cached keys), so the inventory plugin can be tried with a Redis
+# cache without running one. Clients may use RESP2 or RESP3.
+#
+# Usage: python benchmarks/mock_redis.py [--port PORT]
+
+import time
+import argparse
+import threading
+
+try:
+    from socketserver import ThreadingTCPServer, StreamRequestHandler
+except ImportError:
+    from SocketServer import ThreadingTCPServer, StreamRequestHandler
+
+class MockRedis(object):
+    ''' Serves the RESP protocol from memory, counting the commands it receives '''
+    def __init__(self, port=0):
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.strings = {}
+        self.expiry = {}
+        self.zsets = {}
+        ThreadingTCPServer.allow_reuse_address = True
+        self.server = ThreadingTCPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.connection = '127.0.0.1:%d:0' % self.server.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, key):
+        if key in self.expiry and self.expiry[key] <= time.time():
+            self.delete(key)
+        return self.strings.get(key)
+
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            self.expiry.pop(key, None)
+            deleted += (self.strings.pop(key, None) is not None) + (self.zsets.pop(key, None) is not None)
+        return deleted
+
+    def execute(self, command, args):
+        ''' Returns the reply to a command, or an exception for an error reply '''
+        if command == 'GET':
+            return self.get(args[0])
+        if command == 'SET':
+            self.delete(args[0])
+            self.strings[args[0]] = args[1]
+            return 'OK'
+        if command == 'SETEX':
+            self.delete(args[0])
+            self.strings[args[0]] = args[2]
+            self.expiry[args[0]] = time.time() + int(args[1])
+            return 'OK'
+        if command == 'DEL':
+            return self.delete(*args)
+        if command == 'ZADD':
+            zset = self.zsets.setdefault(args[0], {})
+            added = 0
+            for score, member in zip(args[1::2], args[2::2]):
+                added += member not in zset
+                zset[member] = float(score)
+            return added
+        if command in ('ZRANGE', 'ZRANK', 'ZREM', 'ZREMRANGEBYSCORE'):
+            zset = self.zsets.get(args[0], {})
+            members = sorted(zset, key=lambda member: (zset[member], member))
+            if command == 'ZRANGE':
+                start, stop = int(args[1]), int(args[2])
+                return members[start:None if stop == -1 else stop + 1]
+            if command == 'ZRANK':
+                return members.index(args[1]) if args[1] in zset else None
+            if command == 'ZREM':
+                return sum(zset.pop(member, None) is not None for member in args[1:])
+            low, high = float(args[1]), float(args[2])
+            removed = [member for member in members if low <= zset[member] <= high]
+            for member in removed:
+                del zset[member]
+            return len(removed)
+        if command == 'HELLO':
+            return {'server': 'redis', 'version': '7.0.0', 'proto': int(args[0]) if args else 2}
+        if command == 'PING':
+            return 'PONG'
+        if command in ('CLIENT', 'SELECT', 'AUTH'):
+            return 'OK'
+        return ValueError("unknown command '%s'" % command)
+
+    def handler(self):
+        mock = self
+
+        class Handler(StreamRequestHandler):
+            protocol = 2
+
+            def read_command(self):
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                args = []
+                for _ in range(int(line[1:])):
+                    size = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(size + 2)[:-2])
+                return args
+
+            def reply(self, value):
+                if isinstance(value, Exception):
+                    return b'-ERR ' + str(value).encode('utf-8') + b'\r\n'
+                if value is None:
+                    return b'_\r\n' if self.protocol == 3 else b'$-1\r\n'
+                if isinstance(value, int):
+                    return b':%d\r\n' % value
+                if isinstance(value, str):
+                    return b'+' + value.encode('utf-8') + b'\r\n'
+                if isinstance(value, list):
+                    return b'*%d\r\n' % len(value) + b''.join(self.reply(item) for item in value)
+                if isinstance(value, dict):
+                    if self.protocol == 3:
+                        return b'%%%d\r\n' % len(value) + b''.join(self.reply(key) + self.reply(item)
+                                                                   for key, item in value.items())
+                    return self.reply([item for pair in value.items() for item in pair])
+                return b'$%d\r\n' % len(value) + value + b'\r\n'
+
+            def handle(self):
+                while True:
+                    args = self.read_command()
+                    if args is None:
+                        break
+                    with mock.lock:
+                        mock.commands += 1
+                        value = mock.execute(args[0].decode('utf-8').upper(), args[1:])
+                    if isinstance(value, dict):
+                        self.protocol = value['proto']
+                    self.wfile.write(self.reply(value))
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for a Redis server')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+
+    mock = MockRedis(port=args.port)
+    print('Serving Redis on %s' % mock.connection)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
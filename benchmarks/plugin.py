@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compares `ansible-inventory --list` on the abiquo_inventory.py script and
+# on the abiquo inventory plugin against the local stand-in API, checking
+# that both give the same inventory and exiting with an error if they do
+# not. The plugin is also run with its cache in JSON files and in Redis,
+# served by the local stand-in, reporting the first run, which fills the
+# cache, and the second, which reads it.
+#
+# Needs ansible-core, and the community.general collection and the redis
+# package for the Redis cache.
+#
+# Usage: python benchmarks/plugin.py [--vms N] [--latency SECONDS]
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_api import MockAbiquo
+from mock_redis import MockRedis
+
+def plain(obj):
+    ''' Output with the values marked as unsafe by the plugin unwrapped, to compare it with the script's '''
+    if isinstance(obj, dict):
+        if list(obj) == ['__ansible_unsafe']:
+            return obj['__ansible_unsafe']
+        return dict((key, plain(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [plain(item) for item in obj]
+    return obj
+
+def run_inventory(mock, source, env):
+    ''' Runs ansible-inventory --list once, returns wall time, requests and its output '''
+    requests = mock.requests
+    start = time.time()
+    output = subprocess.check_output(['ansible-inventory', '-i', source, '--list'], env=env)
+    return time.time() - start, mock.requests - requests, plain(json.loads(output))
+
+def write_source(workdir, name, cache_plugin=None, cache_connection=None):
+    ''' Writes a plugin source file, with its cache in cache_plugin if given '''
+    source = os.path.join(workdir, '%s.abiquo.yml' % name)
+    with open(source, 'w') as f:
+        f.write('plugin: abiquo\nconfig_file: %s\n' % os.path.join(workdir, 'abiquo_inventory.ini'))
+        if cache_plugin is not None:
+            f.write('cache: true\ncache_plugin: %s\ncache_connection: %s\ncache_timeout: 600\n'
+                    % (cache_plugin, cache_connection))
+    return source
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the inventory script and plugin on a local stand-in API')
+    parser.add_argument('--vms', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every API response (default: 0)')
+    args = parser.parse_args()
+
+    # As in refresh.py, the script runs from a copy with an empty config
+    workdir = tempfile.mkdtemp(prefix='abiquo-bench-')
+    shutil.copy(os.path.join(ROOT, 'abiquo_inventory.py'), workdir)
+    with open(os.path.join(workdir, 'abiquo_inventory.ini'), 'w') as config:
+        config.write('[defaults]\ndefault_net_interface = nic0\ndeployed_only = true\n')
+
+    mock = MockAbiquo(args.vms, latency=args.latency).start()
+    redis = MockRedis().start()
+    env = dict(os.environ, ABIQUO_API_URL=mock.url, ABIQUO_API_USERNAME='admin', ABIQUO_API_PASSWORD='xabiquo',
+               ABIQUO_INV_CACHE_DISABLE='1', ANSIBLE_INVENTORY_PLUGINS=os.path.join(ROOT, 'inventory_plugins'),
+               ANSIBLE_INVENTORY_ENABLED='script,auto', ANSIBLE_DEPRECATION_WARNINGS='False')
+
+    runs = [('script', os.path.join(workdir, 'abiquo_inventory.py'), 1),
+            ('plugin', write_source(workdir, 'nocache'), 1),
+            ('plugin, jsonfile cache', write_source(workdir, 'jsonfile', 'jsonfile',
+                                                    os.path.join(workdir, 'cache')), 2),
+            ('plugin, redis cache', write_source(workdir, 'redis', 'community.general.redis',
+                                                 redis.connection), 2)]
+
+    print('VMs: %d, latency: %.3fs' % (args.vms, args.latency))
+    print('%-26s %10s %10s %10s' % ('', 'wall', 'requests', 'output'))
+    different = []
+    try:
+        expected = None
+        for label, source, times in runs:
+            for run in range(times):
+                name = label + (' (warm)' if run else '')
+                elapsed, requests, output = run_inventory(mock, source, env)
+                if expected is None:
+                    expected = output
+                if output != expected:
+                    different.append(name)
+                print('%-26s %9.2fs %10d %10s' % (name, elapsed, requests,
+                                                  'same' if output == expected else 'DIFFERENT'))
+    finally:
+        mock.stop()
+        redis.stop()
+        shutil.rmtree(workdir)
+    if different:
+        raise SystemExit('FAILED: different output from %s' % ', '.join(different))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Times a full inventory refresh against the local stand-in API at several
+# scales, reporting wall time, API requests and peak RSS of the script.
+#
+# Usage: python benchmarks/refresh.py [--scales 100,1000,10000] [--latency SECONDS]
+#                                     [--failure-rate RATE] [--workers N]
+#                                     [--set KEY=VALUE ...]
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from mock_api import MockAbiquo
+
+# The ru_maxrss of a child includes the memory this process had when it
+# forked, stand-in VMs included, so the script is run by a wrapper that
+# writes its own peak RSS (VmHWM, in kB) to a file when it exits.
+WRAPPER = '''
+import atexit, runpy, sys
+def report(path=sys.argv.pop(1)):
+    with open('/proc/self/status') as status, open(path, 'w') as out:
+        out.write([line.split()[1] for line in status if line.startswith('VmHWM')][0])
+atexit.register(report)
+sys.argv.pop(0)
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+def run_refresh(mock, workdir, env):
+    ''' Runs the script once, returns wall time, requests and peak RSS in MB '''
+    env = dict(env, ABIQUO_API_URL=mock.url, ABIQUO_API_USERNAME='admin', ABIQUO_API_PASSWORD='xabiquo',
+               ABIQUO_INV_CACHE_DISABLE='1')
+    rss_file = os.path.join(workdir, 'rss')
+    requests = mock.requests
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        status = subprocess.call([sys.executable, '-c', WRAPPER, rss_file,
+                                  os.path.join(workdir, 'abiquo_inventory.py'), '--refresh-cache'],
+                                 env=env, stdout=devnull)
+    elapsed = time.time() - start
+    if status != 0:
+        raise SystemExit('abiquo_inventory.py exited with status %d' % status)
+    with open(rss_file) as f:
+        rss = int(f.read()) / 1024.0
+    return elapsed, mock.requests - requests, rss
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark inventory refreshes against a local stand-in API')
+    parser.add_argument('--scales', default='100,1000,10000',
+                        help='Comma separated numbers of VMs (default: 100,1000,10000)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every API response (default: 0)')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of API requests answered with a 503 (default: 0)')
+    parser.add_argument('--workers', type=int,
+                        help='Value for ABIQUO_INV_WORKERS')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='Extra environment variables for the script')
+    args = parser.parse_args()
+
+    # The script reads the .ini next to it, so it runs from a copy with an
+    # empty config to take everything from the environment.
+    workdir = tempfile.mkdtemp(prefix='abiquo-bench-')
+    shutil.copy(os.path.join(ROOT, 'abiquo_inventory.py'), workdir)
+    with open(os.path.join(workdir, 'abiquo_inventory.ini'), 'w') as config:
+        config.write('[defaults]\ndefault_net_interface = nic0\ndeployed_only = true\n')
+
+    env = dict(os.environ)
+    if args.workers is not None:
+        env['ABIQUO_INV_WORKERS'] = str(args.workers)
+    for setting in args.set:
+        key, value = setting.split('=', 1)
+        env[key] = value
+
+    print('latency: %.3fs, failure rate: %.2f' % (args.latency, args.failure_rate))
+    print('%8s %10s %10s %10s' % ('VMs', 'wall', 'requests', 'peak RSS'))
+    try:
+        for vms in [int(scale) for scale in args.scales.split(',')]:
+            mock = MockAbiquo(vms, latency=args.latency, failure_rate=args.failure_rate).start()
+            try:
+                elapsed, requests, rss = run_refresh(mock, workdir, env)
+            finally:
+                mock.stop()
+            print('%8d %9.2fs %10d %8.1fMB' % (vms, elapsed, requests, rss))
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
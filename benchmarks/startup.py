@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Measures the cold-start time and peak memory of `abiquo_inventory.py
+# --list` when the cache is warm: a synthetic inventory is saved to a
+# temporary cache directory and the script is run several times against it.
+#
+# Usage: python benchmarks/startup.py [--hosts N] [--runs N]
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+import tempfile
+import configparser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'abiquo_inventory.py')
+sys.path.insert(0, ROOT)
+
+from abiquo_inventory import AbiquoInventory
+
+def synthetic_inventory(hosts):
+    inv = {'_meta': {'hostvars': {}}}
+    for i in range(hosts):
+        name = 'vm_%d' % i
+        inv['_meta']['hostvars'][name] = {'ansible_host': '10.0.%d.%d' % (i // 250, i % 250),
+                                          'ansible_user': 'root'}
+        for group in ['ABQ_%d' % i, 'vdc_%d' % (i % 10), 'vapp_%d' % (i % 50),
+                      'template_%d' % (i % 7), 'network_%d' % (i % 10)]:
+            inv.setdefault(group, []).append(name)
+    return inv
+
+def save_cache(cache_dir, inv):
+    inventory = AbiquoInventory.__new__(AbiquoInventory)
+    inventory.config = configparser.ConfigParser()
+    os.environ['ABIQUO_INV_CACHE_DIR'] = cache_dir
+    inventory.save_cache(inv)
+
+def time_run(cmd, env):
+    ''' Returns the wall time and peak RSS in KB of cmd '''
+    start = time.time()
+    process = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.WEXITSTATUS(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return time.time() - start, usage.ru_maxrss
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start time of --list on a warm cache')
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp(prefix='abiquo-bench-')
+    save_cache(cache_dir, synthetic_inventory(args.hosts))
+
+    env = dict(os.environ, ABIQUO_INV_CACHE_DIR=cache_dir, ABIQUO_INV_CACHE_TTL='86400')
+    interpreter = sorted(time_run([sys.executable, '-c', 'pass'], env) for _ in range(args.runs))
+    script = sorted(time_run([sys.executable, SCRIPT, '--list'], env) for _ in range(args.runs))
+    compact_env = dict(env, ABIQUO_INV_OUTPUT_STYLE='compact')
+    compact = sorted(time_run([sys.executable, SCRIPT, '--list'], compact_env) for _ in range(args.runs))
+    host = sorted(time_run([sys.executable, SCRIPT, '--host', 'vm_0'], env) for _ in range(args.runs))
+
+    print('hosts: %d, runs: %d' % (args.hosts, args.runs))
+    print('%-26s %8s %8s %10s' % ('', 'min', 'median', 'peak RSS'))
+    for label, runs in [('python -c pass', interpreter), ('--list (warm cache)', script),
+                        ('--list compact (warm cache)', compact), ('--host (warm cache)', host)]:
+        print('%-26s %7.1fms %7.1fms %8.1fMB' % (label, runs[0][0] * 1000, runs[len(runs) // 2][0] * 1000,
+                                               max(rss for _, rss in runs) / 1024.0))
+
+if __name__ == '__main__':
+    main()
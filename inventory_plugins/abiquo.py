@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# (c) 2014, Daniel Beneyto <daniel.beneyto@abiquo.com>
+#           Marc Cirauqui <marc.cirauqui@abiquo.com>
+#
+# This file is part of Ansible,
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+    name: abiquo
+    short_description: Abiquo inventory source
+    description:
+        - Builds the inventory of abiquo_inventory.py from the Abiquo API, adding its groups and host vars
+          straight to Ansible instead of going through a script and its JSON output.
+        - Settings are read from abiquo_inventory.ini and the same environment variables as the script.
+        - The cache of the script is not used, results are cached by the inventory cache plugin instead.
+    extends_documentation_fragment:
+        - inventory_cache
+    options:
+        plugin:
+            description: Token that ensures this is a source file for the plugin.
+            required: true
+            choices: ['abiquo']
+        config_file:
+            description:
+                - Path of the abiquo_inventory.ini settings file.
+                - Defaults to the one next to abiquo_inventory.py.
+            type: path
+        config:
+            description:
+                - Sections of abiquo_inventory.ini, as a dictionary of options per section, taking precedence
+                  over the ones of config_file.
+            type: dict
+            default: {}
+'''
+
+EXAMPLES = r'''
+# abiquo.yml
+plugin: abiquo
+config:
+  api:
+    uri: https://abiquo.example.com/api
+  auth:
+    apiuser: admin
+    apipass: xabiquo
+  profile:
+    data: template
+    groups: vdc, vapp
+
+# Keep the inventory in Redis for 10 minutes
+cache: true
+cache_plugin: community.general.redis
+cache_connection: localhost:6379:0
+cache_timeout: 600
+'''
+
+import argparse
+import configparser
+import os
+import sys
+import threading
+
+from ansible.errors import AnsibleError
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable
+
+try:
+    import abiquo_inventory
+except ImportError:
+    # The plugin lives in inventory_plugins/, next to the script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import abiquo_inventory
+
+
+class PluginInventory(abiquo_inventory.AbiquoInventory):
+    ''' Inventory of the script, built on demand instead of from the command line '''
+    def __init__(self, config):
+        self.inventory = self._empty_inventory()
+        self.config = config
+        self.args = argparse.Namespace(list=True, host=None, refresh_cache=True, refresh_scope=None, profile=None,
+                                       daemon=False, revalidate_lock_fd=None, revalidate_source=None)
+        self.profiler = None
+        self.request_sizes = threading.local()
+
+    def fail_with_error(self, e):
+        raise AnsibleError('Abiquo inventory failed: %s' % e)
+
+
+class InventoryModule(BaseInventoryPlugin, Cacheable):
+
+    NAME = 'abiquo'
+
+    def verify_file(self, path):
+        ''' Only YAML files named abiquo.yml, foo.abiquo.yaml... '''
+        return super(InventoryModule, self).verify_file(path) and \
+            path.endswith(('abiquo.yml', 'abiquo.yaml'))
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        abiquo = PluginInventory(self.abiquo_config())
+        # Enrichment profiles set from the environment get their own entry
+        cache_key = self.get_cache_key(path) + abiquo.cache_key()
+
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        results = None
+        if attempt_to_read_cache:
+            try:
+                results = self._cache[cache_key]
+            except KeyError:
+                cache_needs_update = True
+
+        if results is None:
+            results = abiquo.reload_inventory()
+
+        if cache_needs_update:
+            self._cache[cache_key] = results
+
+        self.populate(results)
+
+    def abiquo_config(self):
+        ''' Settings of the script, from config_file and the config option '''
+        config = configparser.ConfigParser()
+        config_file = self.get_option('config_file') or \
+            os.path.splitext(os.path.abspath(abiquo_inventory.__file__))[0] + '.ini'
+        config.read(config_file)
+        config.read_dict(dict((section, dict((option, str(value)) for option, value in options.items()))
+                              for section, options in self.get_option('config').items()))
+
+        # Results are kept by the inventory cache plugin
+        if not config.has_section('cache'):
+            config.add_section('cache')
+        config.set('cache', 'use_cache', 'false')
+        return config
+
+    def populate(self, results):
+        ''' Adds the hosts and groups of the script output to the inventory, sorted like its JSON '''
+        hostvars = results['_meta']['hostvars']
+        for host in sorted(hostvars):
+            self.inventory.add_host(host)
+            for key, value in hostvars[host].items():
+                self.inventory.set_variable(host, key, value)
+
+        for group in sorted(results):
+            if group == '_meta':
+                continue
+            hosts = results[group]
+            group = self.inventory.add_group(group)
+            for host in hosts:
+                self.inventory.add_child(group, host)